@@ -0,0 +1,243 @@
+"""
+The MIT License
+
+Copyright (c) Tigran Hakobyan. http://tiggreen.me
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+The benchmark suite for all 3 MR prototypes.
+
+Generates synthetic inputs with a fixed seed, so every run of the
+benchmark sees the same data:
+
+.txt  --> WordCount, Zipf distributed words
+.json --> Twitter, JSON lines tweets
+.csv  --> Numeric, numeric columns
+
+and runs every job over a sweep of input sizes, file counts and worker
+counts. Every run happens in a fresh process so its peak RSS (of the
+master and of its workers) is measured on its own. The wall time, peak
+RSS, bytes spilled by the map tasks and the metrics of every phase of
+every run are written to a JSON report.
+
+Usage:
+
+	python benchmark.py --sizes 1M,10M --files 1,4 --workers 1,2,4 --report report.json
+"""
+
+import os
+import sys
+import time
+import json
+import random
+import argparse
+import itertools
+import resource
+import multiprocessing
+
+# importing all three modules.
+from word_count import WordCount
+from twitter_ops import Twitter
+from numeric_ops import Numeric
+
+
+"""
+The jobs of the benchmark: the extension of their input files and how
+to create the job for a list of files.
+"""
+JOBS = {
+	'wordcount': ('txt', lambda files: WordCount(files)),
+	'twitter': ('json', lambda files: Twitter(files, 'lang', 'en')),
+	'numeric': ('csv', lambda files: Numeric(files, 1)),
+}
+
+
+"""
+Write about size bytes of Zipf distributed words to path, so a few
+words are very frequent like in natural language text.
+"""
+def generate_text(path, size, rnd, vocabulary=50000, exponent=1.1):
+	# the cumulative weights are computed once, choices() would redo it per line.
+	cum_weights = list(itertools.accumulate(1 / (rank ** exponent) for rank in range(1, vocabulary + 1)))
+	words = ['w%d' % rank for rank in range(vocabulary)]
+	with open(path, 'w') as fl:
+		written = 0
+		while written < size:
+			line = ' '.join(rnd.choices(words, cum_weights=cum_weights, k=16)) + '\n'
+			fl.write(line)
+			written += len(line)
+
+"""
+Write about size bytes of JSON lines tweets to path.
+"""
+def generate_tweets(path, size, rnd):
+	langs = ['en', 'en', 'en', 'es', 'fr', 'de', 'ja']
+	with open(path, 'w') as fl:
+		written = 0
+		while written < size:
+			tweet = {
+				'id': rnd.randrange(10 ** 12),
+				'lang': rnd.choice(langs),
+				'user': {'id': rnd.randrange(10 ** 6), 'followers_count': rnd.randrange(10 ** 5)},
+				'text': ' '.join('w%d' % rnd.randrange(5000) for i in range(rnd.randrange(3, 20))),
+			}
+			line = json.dumps(tweet) + '\n'
+			fl.write(line)
+			written += len(line)
+
+"""
+Write about size bytes of numeric rows with a header to path.
+"""
+def generate_numeric(path, size, rnd, columns=4):
+	with open(path, 'w') as fl:
+		header = ','.join('c%d' % c for c in range(columns)) + '\n'
+		fl.write(header)
+		written = len(header)
+		while written < size:
+			line = ','.join(str(rnd.randrange(-10 ** 6, 10 ** 6)) for c in range(columns)) + '\n'
+			fl.write(line)
+			written += len(line)
+
+GENERATORS = {'txt': generate_text, 'json': generate_tweets, 'csv': generate_numeric}
+
+
+"""
+Generate (or reuse) the input of a run: num_files files of the given
+extension holding size bytes in total. The files are named after their
+parameters, so they are generated once per data directory.
+"""
+def generate_inputs(data_dir, ext, size, num_files, seed):
+	files = []
+	for i in range(num_files):
+		path = os.path.join(data_dir, '%s-%d-%d-%d-%d.%s' % (ext, size, num_files, seed, i, ext))
+		if not os.path.exists(path):
+			rnd = random.Random('%s-%d-%d' % (ext, seed, i))
+			GENERATORS[ext](path + '.tmp', size // num_files, rnd)
+			os.replace(path + '.tmp', path)
+		files.append(path)
+	return files
+
+"""
+Parse a size like 512K, 10M or 1G into bytes.
+"""
+def parse_size(text):
+	units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+	text = text.strip().upper()
+	if text[-1:] in units:
+		return int(float(text[:-1]) * units[text[-1]])
+	return int(text)
+
+"""
+Run one job in the current process and send its measurements to conn.
+Runs in a fresh process per run, see run_job.
+"""
+def measure(conn, job, files, workers, scratch_dir):
+	mr_job = JOBS[job][1](files)
+	mr_job.num_processes = workers
+	mr_job.scratch_dirs = [scratch_dir]
+	mr_job.output = os.path.join(scratch_dir, 'output-' + job)
+	mr_job.resumable = False
+
+	start_time = time.time()
+	metrics = mr_job.run_program()
+	wall_time = time.time() - start_time
+
+	# ru_maxrss is in kilobytes on Linux. The workers of the job were
+	# joined, so they are accounted for in RUSAGE_CHILDREN.
+	conn.send({
+		'wall_time': wall_time,
+		'peak_rss_master': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+		'peak_rss_worker': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+		'bytes_spilled': int(mr_job.stats['map']['bytes_written']),
+		'records_spilled': int(mr_job.stats['map']['records_written']),
+		'phases': metrics['phases'],
+	})
+	conn.close()
+
+"""
+Run one job in a fresh process and return its measurements.
+"""
+def run_job(job, files, workers, scratch_dir):
+	receiver, sender = multiprocessing.Pipe(duplex=False)
+	process = multiprocessing.Process(target=measure, args=(sender, job, files, workers, scratch_dir))
+	process.start()
+	sender.close()
+	try:
+		result = receiver.recv()
+	except EOFError:
+		result = None
+	process.join()
+	if result is None:
+		raise RuntimeError('The %s job failed with exit code %s.' % (job, process.exitcode))
+	return result
+
+"""
+Run every job over every combination of size, file count and worker
+count repeat times and return the report.
+"""
+def run_benchmark(jobs, sizes, file_counts, worker_counts, repeat, data_dir, seed):
+	os.makedirs(data_dir, exist_ok=True)
+	report = {
+		'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+		'python': sys.version.split()[0],
+		'cpu_count': os.cpu_count(),
+		'seed': seed,
+		'runs': [],
+	}
+	for job in jobs:
+		ext = JOBS[job][0]
+		for size in sizes:
+			for num_files in file_counts:
+				files = generate_inputs(data_dir, ext, size, num_files, seed)
+				for workers in worker_counts:
+					for attempt in range(repeat):
+						result = run_job(job, files, workers, data_dir)
+						result.update({'job': job, 'size': size, 'files': num_files,
+							'workers': workers, 'repeat': attempt})
+						report['runs'].append(result)
+						print('%-9s size=%-10d files=%-3d workers=%-3d %.3fs  peak rss %d MB' % (job, size, num_files,
+							workers, result['wall_time'], max(result['peak_rss_master'], result['peak_rss_worker']) // 2 ** 20))
+	return report
+
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description='Benchmark the MapReduce framework on synthetic data.')
+	parser.add_argument('--jobs', default=','.join(JOBS), help='comma separated jobs: ' + ', '.join(JOBS))
+	parser.add_argument('--sizes', default='1M,8M', help='comma separated total input sizes, e.g. 512K,10M,1G')
+	parser.add_argument('--files', default='1,4', help='comma separated numbers of input files')
+	parser.add_argument('--workers', default=str(os.cpu_count() or 1), help='comma separated numbers of workers')
+	parser.add_argument('--repeat', type=int, default=1, help='runs per combination')
+	parser.add_argument('--seed', type=int, default=1, help='seed of the data generators')
+	parser.add_argument('--data-dir', default='benchmark_data', help='where the inputs are generated')
+	parser.add_argument('--report', default='benchmark_report.json', help='the JSON report file')
+	args = parser.parse_args()
+
+	jobs = args.jobs.split(',')
+	for job in jobs:
+		if job not in JOBS:
+			parser.error('unknown job ' + job)
+
+	report = run_benchmark(jobs, [parse_size(size) for size in args.sizes.split(',')],
+		[int(n) for n in args.files.split(',')], [int(n) for n in args.workers.split(',')],
+		args.repeat, args.data_dir, args.seed)
+
+	with open(args.report, 'w') as fl:
+		json.dump(report, fl, indent=1)
+	print('The report was written to ' + args.report + '.')
@@ -49,13 +49,45 @@ import logging
 import ntpath
 import time
 import pickle
-import string
 import csv
 import json
-import multiprocessing
-import multiprocessing.pool
+import collections.abc
+import heapq
+import glob
+import itertools
+import zlib
+import lzma
+import bz2
+import struct
+import marshal
+import mmap
+import io
+import queue
+import shutil
+import hashlib
+import uuid
+import re
+import cProfile
+import pstats
+import tracemalloc
 from multiprocessing import Pool
-from collections import defaultdict
+from collections import defaultdict, Counter, namedtuple
+from operator import itemgetter
+
+# resource is Unix only; without it the peak memory of tasks isn't known.
+try:
+	import resource
+except ImportError:
+	resource = None
+
+"""
+Set up the log of the framework, map_reduce.log. Called by everything
+that logs before a job does (jobs and job runners): the first call to
+logging.info() would otherwise set up a default log of its own.
+"""
+def configure_logging():
+	logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p',
+		filename='map_reduce.log', level=logging.INFO)
 
 """
 Class MapReduce.
@@ -63,6 +95,19 @@ The core class that's used by framework.
 """
 
 class MapReduce:
+
+	"""
+	The byte patterns that chunk boundaries are snapped to and
+	the size of the blocks read while looking for them.
+	"""
+	whitespace = re.compile(rb'[ \t\n\r\x0b\x0c]')
+	newline = re.compile(rb'\n')
+	scan_block_size = 1 << 16
+
+	"""
+	The strings no mainstream JSON encoder escapes, see json_needles.
+	"""
+	json_plain = re.compile(r'[A-Za-z0-9 _.:-]*')
 	
 	"""
 	Return the name of the given file.   
@@ -79,264 +124,974 @@ class MapReduce:
 		return os.path.splitext(filename)[1][1:]
 
 	"""
-	m: the map function defined by user.
-	r: the reduce function defined by user.
-	f: the file that the MapReduce object should run on.
-	np: the number of processes that should run on a file.
+	Partition the file f based on its extension and return its
+	chunks as a list of Split tasks for the mappers.
 	"""
-	def __init__(self, m, r, f, np):
-		self.mapper = m
-		self.reducer = r
+	def plan_file(self, f):
 		self.file = f
-		self.num_processes = np
 		self.file_ext = MapReduce.get_file_extension(self.file)
-		# partition the file based on its extension.
 		self.partition(self.file_ext)
-		# run the master process.
-		self.run_master()
+		return [Split(self.file, i, start, end, self.header) for i, (start, end) in enumerate(self.splits)]
 
-		
 	"""
-	Open a #part-filename-chunkindex file and 
-	run the map() method on the chunk. Writes the 
-	result of the map into a temporary file named
-	#map-filename-chunkindex. The map result is a
-	serialized stream.
+	Run the map task t, i.e. open the chunk of every split of the task
+	(small files are packed into one task) and run the map() method on it.
+	The mapper may return a list or yield its (key, value) pairs; either
+	way they are consumed one at a time and grouped by key. Every pair is
+	routed to one of num_partitions partitions by the partitioner.
+	The groups are kept in memory until more than spill_threshold values are
+	buffered, then each partition is sorted by key and spilled to a run file
+	named partitionindex-spillindex in the output directory of the task.
+	A reducer merges the sorted runs of its own partitions later on.
+
+	attempt: the attempt number of the task. Every attempt writes into its
+	own directory which is committed atomically, see commit_task.
+	Returns (t, whether this attempt won, the I/O counters of the task,
+	a sample of the output) where the sample holds the bytes written for
+	every partition and the keys with the most values.
 	"""
-	def apply_map(self, i):
+	def apply_map(self, task, attempt=0):
 
-		filename = MapReduce.get_filename(self.file)
-		chunk_file = open("#part-%s-%s" % (filename, i))
+		t, splits, cache_key = task
+		self.task_stats = Counter()
+		self.sample = {'sizes': Counter(), 'hot_keys': Counter()}
+		output = self.task_path('map', t)
+		attempt_output = output + '.attempt-%s' % attempt
 
-		logging.info('Started the map phase for ' + filename + ' chunk #' + str(i) + '.') 
+		# an unchanged input may have been mapped by an earlier job already.
+		if self.cache_load(cache_key, attempt_output):
+			logging.info('Took the output of the map task ' + str(t) + ' from the cache.')
+			return (t, self.commit_task('map', t, attempt_output), self.task_stats, self.sample)
+		os.mkdir(attempt_output)
 
-		# call the user defined mapper on the chunk.
-		map_result = self.mapper(chunk_file)
+		# group the map output while the user defined mapper produces it.
+		# {'n': [1], 'm': [1], 't': [1, 1, 1]})
+		partitions = [defaultdict(list) for r in range(self.num_partitions)]
+		buffered = 0
+		spill = 0
+		for split in splits:
+			self.file = split.file
+			self.file_ext = MapReduce.get_file_extension(self.file)
+			self.header = split.header
+			filename = MapReduce.get_filename(self.file)
+			chunk_file = self.open_chunk(split)
+
+			logging.info('Started the map phase for ' + filename + ' chunk #' + str(split.index) + '.') 
+
+			records = 0
+			for records, (key, value) in enumerate(self.mapper(chunk_file), 1):
+				partitions[self.partitioner(key, self.num_partitions)][key].append(value)
+				buffered += 1
+				if buffered >= self.spill_threshold:
+					self.spill(partitions, attempt_output, spill)
+					partitions = [defaultdict(list) for r in range(self.num_partitions)]
+					buffered = 0
+					spill += 1
+
+			# close the chunk file.
+			chunk_file.close()
+			self.task_stats['map_input_bytes'] += split.end - split.start
+			self.task_stats['map_output_records'] += records
+
+		if buffered:
+			self.spill(partitions, attempt_output, spill)
+			spill += 1
+
+		# keep the sample with the output so a resumed job can plan without rerunning the task.
+		with open(os.path.join(attempt_output, '_sample'), 'wb') as fl:
+			pickle.dump(self.sample, fl)
+		self.cache_store(cache_key, attempt_output)
+
+		logging.info('Finished the map task ' + str(t) + ' over ' + str(len(splits)) + \
+			' chunks with ' + str(spill) + ' spills.')
+		return (t, self.commit_task('map', t, attempt_output), self.task_stats, self.sample)
 
-		# close the chunk file and remove it.
-		chunk_file.close()
-		logging.info('Finished the map phase for ' + filename + ' chunk #' + str(i) + '.') 
-		os.remove("#part-%s-%s" % (filename, i))
 
-		"""
-		Marshal (serialize) the map result and
-		write it to a temporary file.
-		"""
+	"""
+	Run the reduce task i. Each partition of the task is pulled straight
+	from the sorted runs of every map task (or of the combine tasks of a
+	hot partition) by the shuffle, and the groups of all the partitions
+	are handed to the reducer as one stream. Keys are sorted within a
+	partition only.
+	The reducer may return a list or yield its results; they are written
+	one by one into the output part of the task in the output_format of
+	the job. Any other return value is written as a single result.
+	With sort_output the results are sorted first. If the parts are
+	merged into one sorted file afterwards, the task writes its sorted
+	results as a record file instead and the merge formats them. With
+	the 'records' output format the part is a record file anyway.
+
+	attempt: the attempt number of the task, see apply_map.
+	Returns (i, whether this attempt won, the I/O counters of the task, None).
+	"""
+	def apply_reduce(self, task, attempt=0):
+
+		i, partitions = task
+		logging.info('Partitions ' + str(partitions) + ' were assigned to reducer #' + str(i) + '.') 
+		self.task_stats = Counter()
+
+		attempt_output = self.task_path('reduce', i) + '.attempt-%s' % attempt
+		# call the reducer once on the shuffled map result of all the partitions.
+		groups = itertools.chain.from_iterable(self.shuffle(self.partition_runs(r)) for r in partitions)
+		reduce_result = self.reducer(self.count_items(groups, 'reduce_input_groups'))
+		if not isinstance(reduce_result, (list, collections.abc.Iterator)):
+			reduce_result = [reduce_result]
+
+		if self.sort_output:
+			sort_dir = attempt_output + '.sort'
+			os.mkdir(sort_dir)
+			reduce_result = self.sort_records(reduce_result, sort_dir)
+		if (self.sort_output and not self.output_parts) or self.output_format == 'records':
+			writer = self.record_writer(attempt_output, 'reduce')
+			for record in reduce_result:
+				writer.write(record)
+			writer.close()
+		else:
+			with open(attempt_output, 'w', newline='') as fl:
+				write = self.output_record_writer(fl)
+				for record in reduce_result:
+					write(record)
+					self.task_stats['records_written'] += 1
+				size = fl.tell()
+			self.task_stats['bytes_written'] += size
+			self.task_stats['raw_bytes_written'] += size
+		if self.sort_output:
+			shutil.rmtree(sort_dir)
+		logging.info('Wrote the reduce results of reducer #' + str(i) + '.') 
+
+		return (i, self.commit_task('reduce', i, attempt_output), self.task_stats, None)
+
+	"""
+	Run the combine task c of a hot partition: merge the sorted runs the
+	given sources (map or merge tasks) wrote for the partition and pass
+	every group through the combiner, so the reducer of the partition only
+	has to merge the few combined runs. Returns the same tuple as apply_reduce.
+	"""
+	def apply_combine(self, task, attempt=0):
+
+		c, r, sources = task
+		self.task_stats = Counter()
+		run_files = []
+		for phase, t in sources:
+			run_files.extend(self.task_runs(phase, t, r))
 
-		fl = open("#map-%s-%s" % (filename, i), "wb+")
-		logging.info('Serializing and writing the map results for ' + filename + ' chunk #' + str(i) + '.')
-		pickle.dump(map_result, fl)
-		fl.close()
+		attempt_output = self.task_path('combine', c) + '.attempt-%s' % attempt
+		self.merge_runs(run_files, attempt_output)
+		logging.info('Combined partition #' + str(r) + ' of ' + str(len(sources)) + ' tasks.')
 
+		return (c, self.commit_task('combine', c, attempt_output), self.task_stats, None)
 
 	"""
-	Open a #inter-shuffled-chunkindex file and 
-	run the reduce() method on the file. Writes the 
-	result of the reduce into a temporary file named
-	#reduce-filename-chunkindex. The reduce result is a
-	serialized stream.
+	Run one attempt of a task with func (apply_map, apply_combine or
+	apply_reduce) and measure it: its wall and CPU time, the peak memory
+	of the worker so far and the counters the user incremented.
+	Returns the result of func with the metrics of the task appended.
 	"""
-	def apply_reduce(self, i):
+	def run_task(self, func, task, attempt):
+		self.counters = Counter()
+		profiled = self.profiled(task[0], attempt)
+		if profiled:
+			profiler = self.start_profiling()
+		try:
+			wall_start = time.time()
+			cpu_start = time.process_time()
+			t, won, task_stats, sample = func(task, attempt)
+			task_stats['wall_time'] = time.time() - wall_start
+			task_stats['cpu_time'] = time.process_time() - cpu_start
+
+			metrics = {'task': t, 'attempt': attempt, 'worker': os.getpid()}
+			if profiled:
+				metrics['profile'] = self.stop_profiling(profiler, func.__name__[len('apply_'):], t)
+		finally:
+			# a failed task leaves no profile, but its profilers must not keep
+			# running in the worker (stopping them twice is harmless).
+			if profiled:
+				if profiler is not None:
+					profiler.disable()
+				if 'tracemalloc' in self.profile:
+					tracemalloc.stop()
+		metrics.update(task_stats)
+		# ru_maxrss is in kilobytes on Linux.
+		metrics['peak_memory'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 if resource else None
+		metrics['counters'] = dict(self.counters)
+		return (t, won, task_stats, sample, metrics)
 
-		fl = open("#inter-shuffled-%s" % i, "rb")
-		# load the shuffled map results.
-		map_shuffled_result = pickle.load(fl)
-		fl.close()
-		os.remove("#inter-shuffled-%s" % i)
+	"""
+	Return whether the given attempt of task t is profiled: only first
+	attempts are, and a stable profile_sample fraction of the tasks.
+	"""
+	def profiled(self, t, attempt):
+		if not self.profile or attempt > 0:
+			return False
+		return zlib.crc32(str(t).encode('utf-8')) % 10000 < self.profile_sample * 10000
 
-		# call the reducer on the shuffled map result.
-		filename = "#inter-shuffled-%s" % i
-		logging.info('Chunk ' + filename + ' was assigned to a reducer.') 
-		reduce_result = self.reducer(map_shuffled_result)
+	"""
+	Start the profilers of the job in this worker: cProfile and/or
+	tracemalloc. Returns the cProfile profiler or None.
+	"""
+	def start_profiling(self):
+		profiler = None
+		if 'tracemalloc' in self.profile:
+			tracemalloc.start(self.profile_frames)
+		if 'cprofile' in self.profile:
+			profiler = cProfile.Profile()
+			profiler.enable()
+		return profiler
 
-		fl = open("#reduce-%s" % i, "wb+")
-		logging.info('Serializing and writing the reduce results for #inter-shuffled #' + str(i) + '.') 
-		pickle.dump(reduce_result, fl)
-		fl.close()
+	"""
+	Stop the profilers and dump their results for the task t of the
+	phase into profile_dir: a phase-t.prof file with the cProfile stats
+	and a phase-t.tracemalloc file with a snapshot of the memory still
+	allocated. The peak of the traced memory is added to the counters of
+	the task as traced_peak_memory. Returns the paths of the files.
+	"""
+	def stop_profiling(self, profiler, phase, t):
+		paths = []
+		path = os.path.join(self.profile_dir, '%s-%s' % (phase, t))
+		if profiler is not None:
+			profiler.disable()
+			profiler.dump_stats(path + '.prof')
+			paths.append(path + '.prof')
+		if tracemalloc.is_tracing():
+			# leave out what the profilers allocated themselves.
+			snapshot = tracemalloc.take_snapshot().filter_traces([
+				tracemalloc.Filter(False, cProfile.__file__),
+				tracemalloc.Filter(False, tracemalloc.__file__)])
+			self.task_stats['traced_peak_memory'] = tracemalloc.get_traced_memory()[1]
+			tracemalloc.stop()
+			snapshot.dump(path + '.tracemalloc')
+			paths.append(path + '.tracemalloc')
+		return paths
 
+	"""
+	Increment the user defined counter name by amount. May be called
+	from the mapper, combiner or reducer; the counters of all tasks are
+	summed up in the metrics of the job.
+	"""
+	def increment_counter(self, name, amount=1):
+		self.counters[name] += amount
 
 	"""
-	The goal of this step is to group the (key, value) pairs by key.
-	We want to make sure that each all keys are grouped before a reducer takes over. 
+	Yield the items of an iterable, counting them in the counter name
+	of the task.
 	"""
-	def apply_intermediate(self, i):
+	def count_items(self, items, name):
+		for item in items:
+			self.task_stats[name] += 1
+			yield item
 
-		filename = MapReduce.get_filename(self.file)
-		fl = open("#map-%s-%s" % (filename, i), "rb")
+	"""
+	Run the merge task m while other map tasks are still running: merge
+	the sorted runs the given finished map tasks wrote into one sorted run
+	per partition, passing every group through the combiner if there is
+	one. The reducers then have fewer runs to merge.
+	Returns the same tuple as apply_reduce.
+	"""
+	def apply_merge(self, task, attempt=0):
+
+		m, map_tasks = task
+		self.task_stats = Counter()
+		attempt_output = self.task_path('merge', m) + '.attempt-%s' % attempt
+		os.mkdir(attempt_output)
+		for r in range(self.num_partitions):
+			run_files = []
+			for t in map_tasks:
+				run_files.extend(self.task_runs('map', t, r))
+			if run_files:
+				self.merge_runs(run_files, os.path.join(attempt_output, "%s-0" % r))
+		logging.info('Merged the runs of ' + str(len(map_tasks)) + ' map tasks.')
+
+		return (m, self.commit_task('merge', m, attempt_output), self.task_stats, None)
 
-		# load the map result.
-		map_result = pickle.load(fl)
-		fl.close()
-		os.remove("#map-%s-%s" % (filename, i))
+	"""
+	Merge sorted run files into one sorted run at path. The values of a
+	key are grouped into one record, through the combiner if there is one.
+	"""
+	def merge_runs(self, run_files, path):
+		writer = self.record_writer(path, 'map')
+		for key, values in self.shuffle(run_files):
+			if self.combiner is not None:
+				values = [value for k, value in self.combiner([(key, values)])]
+			else:
+				values = list(values)
+			writer.write((key, values))
+		writer.close()
+
+	"""
+	Return the sorted runs the map or merge task t wrote for partition r.
+	"""
+	def task_runs(self, phase, t, r):
+		return glob.glob(os.path.join(glob.escape(self.task_path(phase, t)), "%s-*" % r))
+
+	"""
+	Return all the sorted runs of partition r: the combined runs if the
+	partition was combined, otherwise the runs of every source (merge
+	task, or map task whose runs were not merged).
+	"""
+	def partition_runs(self, r):
+		if r in self.combined:
+			return [self.task_path('combine', c) for c in self.combined[r]]
+		run_files = []
+		for phase, t in self.run_sources:
+			run_files.extend(self.task_runs(phase, t, r))
+		return run_files
+
+	"""
+	Return the path of the output of the given task of the job. The
+	outputs are spread over the work directories by task id.
+	"""
+	def task_path(self, phase, t):
+		work_dir = self.work_dirs[int(t, 16) % len(self.work_dirs)]
+		return os.path.join(work_dir, '%s-%s' % (phase, t))
+
+	"""
+	Atomically publish the output of a task attempt. The first attempt
+	that creates the done marker of the task wins and renames its output
+	into place; the output of any later attempt is discarded. Return
+	whether this attempt won.
+	"""
+	def commit_task(self, phase, t, attempt_output):
+		try:
+			os.close(os.open(self.task_path(phase, t) + '.done', os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+		except FileExistsError:
+			if os.path.isdir(attempt_output):
+				shutil.rmtree(attempt_output)
+			else:
+				os.remove(attempt_output)
+			return False
+		os.rename(attempt_output, self.task_path(phase, t))
+		return True
+
+
+	"""
+	Copy the cached output with the given key (if any) to attempt_output
+	and load its sample. Files are hard linked when the cache is on the
+	same file system; cached files are never modified. Returns whether
+	the cache had the output.
+	"""
+	def cache_load(self, key, attempt_output):
+		if key is None:
+			return False
+		entry = os.path.join(self.cache_dir, key)
+		try:
+			shutil.copytree(entry, attempt_output, copy_function=MapReduce.link_or_copy)
+			with open(os.path.join(attempt_output, '_sample'), 'rb') as fl:
+				self.sample = pickle.load(fl)
+		except OSError:
+			shutil.rmtree(attempt_output, ignore_errors=True)
+			self.task_stats['cache_misses'] += 1
+			return False
+		# the modification time of an entry is its last use, see evict_cache.
+		os.utime(entry)
+		self.task_stats['cache_hits'] += 1
+		return True
+
+	"""
+	Store the output of a map task in the cache under the given key. The entry is built
+	under a temporary name and renamed into place, so a concurrent job
+	storing the same entry or reading the cache never sees half of it.
+	"""
+	def cache_store(self, key, attempt_output):
+		if key is None:
+			return
+		entry = os.path.join(self.cache_dir, key)
+		tmp = entry + '.tmp-' + str(os.getpid())
+		try:
+			shutil.copytree(attempt_output, tmp, copy_function=MapReduce.link_or_copy)
+			os.rename(tmp, entry)
+		except OSError:
+			shutil.rmtree(tmp, ignore_errors=True)
+
+	"""
+	Hard link src to dst, or copy it if they are on different file systems.
+	"""
+	@classmethod
+	def link_or_copy(cls, src, dst):
+		try:
+			os.link(src, dst)
+		except OSError:
+			shutil.copy2(src, dst)
+
+	"""
+	Write every non-empty partition of a grouping buffer to its own
+	sorted run file in directory. The combiner (if any) runs on the buffer first.
+	Adds the size of every run and the number of values of the hottest
+	keys of the buffer to the sample of the task.
+	"""
+	def spill(self, partitions, directory, spill):
+		hot_keys = self.sample['hot_keys']
+		for r, dic in enumerate(partitions):
+			if dic:
+				hot_keys.update({key: len(values) for key, values in dic.items()})
+				if self.combiner is not None:
+					dic = self.combine(dic)
+				path = os.path.join(directory, "%s-%s" % (r, spill))
+				self.write_run(path, dic)
+				self.sample['sizes'][r] += os.path.getsize(path)
+		self.sample['hot_keys'] = Counter(dict(hot_keys.most_common(self.hot_key_sample)))
+
+	"""
+	Run the user defined combiner on a {key: [values]} dictionary and
+	group its (key, value) output back into a new dictionary.
+	"""
+	def combine(self, dic):
+		combined = defaultdict(list)
+		for key, value in self.combiner(list(dic.items())):
+			combined[key].append(value)
+		return combined
 
-		# start the grouping stage.
-		# {'n': [1], 'm': [1], 't': [1, 1, 1]})
-		logging.info('Started the grouping phase for ' + filename + ' chunk #' + str(i) + '.') 
-		dic = defaultdict(list)
-		for key, value in map_result:
-			dic[key].append(value)
 
-		fl = open("#inter-%s-%s" % (filename, i), "wb+")
-		pickle.dump(dic, fl)
-		fl.close()
+	"""
+	Write the (key, [values]) groups of dic to a run file sorted by key.
+	Every group is a separate record so the run can be read back
+	one group at a time.
+	"""
+	def write_run(self, path, dic):
+		writer = self.record_writer(path, 'map')
+		for key in sorted(dic):
+			writer.write((key, dic[key]))
+		writer.close()
 
+	"""
+	Sort the records with an external merge sort: sorted runs of at most
+	spill_threshold records are written to directory and merged lazily.
+	The records are ordered by output_sort_key, or by themselves if it is None.
+	records may be any iterable, e.g. the list a reducer returned.
+	"""
+	def sort_records(self, records, directory):
+		key = self.output_sort_key
+		records = iter(records)
+		runs = []
+		for batch in iter(lambda: list(itertools.islice(records, self.spill_threshold)), []):
+			batch.sort(key=key)
+			path = os.path.join(directory, str(len(runs)))
+			writer = self.record_writer(path, 'reduce')
+			for record in batch:
+				writer.write(record)
+			writer.close()
+			runs.append(path)
+		return heapq.merge(*[MapReduce.read_run(path, self.task_stats) for path in runs], key=key)
+
+	"""
+	Return a function that writes one result record to the text file fl
+	in the output_format of the job. Tuples and lists are written as the
+	fields of a tsv or csv row, anything else as a single field.
+	"""
+	def output_record_writer(self, fl):
+		fmt = self.output_format
+		if fmt == 'csv':
+			writer = csv.writer(fl)
+			return lambda record: writer.writerow(record if isinstance(record, (tuple, list)) else [record])
+		if fmt == 'tsv':
+			return lambda record: fl.write(('\t'.join(map(str, record)) if isinstance(record, (tuple, list)) \
+				else str(record)) + '\n')
+		if fmt == 'jsonl':
+			return lambda record: fl.write(json.dumps(record, default=str) + '\n')
+		return lambda record: fl.write(str(record) + '\n')
+
+	"""
+	Lazily read the records of a run file one by one.
+	"""
+	@classmethod
+	def read_run(cls, path, stats=None):
+		return iter(RecordReader(path, stats=stats))
+
+	"""
+	Create a RecordWriter for an intermediate file of the given stage
+	('map' or 'reduce') using the codec and compression of the job. The
+	I/O counters of the writer are added to the counters of the task.
+	"""
+	def record_writer(self, path, stage):
+		compression = self.intermediate_compression
+		if isinstance(compression, dict):
+			compression = compression.get(stage)
+		return RecordWriter(path, self.intermediate_codec, compression=compression,
+			level=self.compression_level, stats=self.task_stats)
 
 	"""
 	Partition the given file into multiple chunks. All the partition 
 	methods support stream parsing which means that you do not need to
 	hold the whole JSON, CSV or TXT representation in textual form in memory. 
-	The number of chunks is equal to the number of processes. Based on the
+	The number of chunks is at most the number of processes. Based on the
 	file extension the splitting will be handled accordingly. 
 	For a .txt file the word boundaries are considered.
 	By default it assumes that the file format is 'txt'.
 	"""
 	def partition(self, ext):
+		self.header = None
 		if ext == 'csv':
 			self.__partition_csv()
 		elif ext == 'json':
 			self.__partition_json()
+		elif ext == 'mrr':
+			self.__partition_records()
 		else:
 			self.__partition_text()
 
 	"""
-	Partition a txt file into smaller chunks.
+	Open the chunk of the given split for reading. Byte range chunks are read
+	in place from the input file, nothing is copied. A json chunk is a
+	lazy iterator of the parsed documents rather than a file, and so is
+	a chunk of a record file (e.g. the output of an earlier job of a
+	JobChain). A csv chunk holds data rows only, the header is available
+	as self.header.
+	"""
+	def open_chunk(self, split):
+		start, end = split.start, split.end
+		if self.file_ext == 'json':
+			return self.json_records(start, end)
+		if self.file_ext == 'mrr':
+			return iter(RecordReader(self.file, start, end, stats=self.task_stats))
+		newline = '' if self.file_ext == 'csv' else None
+		return io.TextIOWrapper(io.BufferedReader(FileRange(self.file, start, end)), newline=newline)
+
+	"""
+	Partition a txt file into smaller chunks. Only the split offsets are
+	computed: the chunks are (start, end) byte ranges of the file that
+	end right after a whitespace, so a word is never split into parts.
 	"""
 	def __partition_text(self):
+		logging.info('Partitioning ' + MapReduce.get_filename(self.file) + \
+			 ' into ' + str(self.num_chunks()) + ' chunks.')
+		self.splits = self.split_offsets(MapReduce.whitespace)
 
+	"""
+	Return the number of chunks of about split_bytes bytes the file
+	should be split into.
+	"""
+	def num_chunks(self):
+		return max(1, -(-os.path.getsize(self.file) // self.split_bytes))
 
-		# return the size of the file in bytes.
+	"""
+	Compute the (start, end) byte ranges that split the file into 
+	chunks of about the same size (see num_chunks). Each nominal offset is
+	moved forward to just after the next match of the delimiter pattern.
+	Empty ranges are dropped, so small files may get fewer chunks.
+	"""
+	def split_offsets(self, delimiter):
 		file_size = os.path.getsize(self.file)
-		filename = MapReduce.get_filename(self.file)
+		chunk = file_size // self.num_chunks() + 1
+		offsets = [0]
+		with open(self.file, "rb") as fl:
+			for k in range(1, self.num_chunks()):
+				target = max(chunk * k, offsets[-1])
+				if target >= file_size:
+					break
+				fl.seek(target)
+				offsets.append(MapReduce.next_boundary(fl, delimiter))
+		offsets.append(file_size)
+		return [(start, end) for start, end in zip(offsets, offsets[1:]) if start < end]
 
-		chunk = file_size // self.num_processes + 1
-		logging.info('Partitioning ' + MapReduce.get_filename(self.file) + \
-			 ' into ' + str(self.num_processes) + ' chunks.')
-
-		# open the file
-		fl = open(self.file)
-		# read the whole file
-		buff = fl.read()
-		# close the file
-		fl.close()
-
-		fl = open("#part-%s-%s" % (filename, 0), "w+")
-		fl.write(str(0) + "\n")
-		# each char is one byte 
-		num_bytes = 0
-		chunk_num = 1
-
-		for ch in buff:
-			fl.write(ch)
-			num_bytes += 1
-			"""
-			Make sure we never split a word into parts so we can gently
-			handle this case. If the number of bytes is greater than the size of 
-			a chunk then create a new part file. 
-			"""
-			if (ch in string.whitespace) and (num_bytes > chunk * chunk_num):
-				fl.close()
-				chunk_num += 1
-				fl = open("#part-%s-%s" % (filename, chunk_num-1), "w+")
-				fl.write(str(num_bytes) + "\n")
-
-		fl.close()
+	"""
+	Scan a binary file forward from its current position and return the
+	offset right after the first match of the delimiter pattern, or the
+	end of the file.
+	"""
+	@classmethod
+	def next_boundary(cls, fl, delimiter):
+		pos = fl.tell()
+		while True:
+			block = fl.read(MapReduce.scan_block_size)
+			if not block:
+				return pos
+			match = delimiter.search(block)
+			if match:
+				return pos + match.end()
+			pos += len(block)
 
-	
 	"""
 	Partitions a CSV file into multiple chunks. Performs stream partitioning
 	which means the whole csv representation is never loaded into memory.
+	The first row is the header: it is parsed into self.header so mappers
+	can look columns up by name, and the remaining rows are split into
+	row aligned (start, end) byte ranges in a single pass over the file.
 
 	delimiter: by default it's ','. 
-	temp_output_name: a %s-style template for the numbered temp output files.
 	"""
-	def __partition_csv(self, delimiter=',',temp_output_name='#part-%s-%s'):
+	def __partition_csv(self, delimiter=','):
 
 		logging.info('Partitioning ' + MapReduce.get_filename(self.file) + \
-			 ' into ' + str(self.num_processes) + ' chunks.')
+			 ' into ' + str(self.num_chunks()) + ' chunks.')
 
-		filename = MapReduce.get_filename(self.file)
+		file_size = os.path.getsize(self.file)
+		chunk = file_size // self.num_chunks() + 1
+		# the first target is 0 so the first boundary is the end of the header.
+		offsets = self.csv_row_offsets([chunk * k for k in range(0, self.num_chunks())])
+		header_end = offsets[0] if offsets else file_size
 
-		# counting the number of lines of the csv files.
-		num_lines = sum(1 for line in open(self.file))
-		row_limit = num_lines // self.num_processes
-		reader = csv.reader(open(self.file), delimiter=delimiter)
-		# skipping the header
-		next(reader)
+		with open(self.file, newline='') as fl:
+			self.header = next(csv.reader(io.StringIO(fl.read(header_end)), delimiter=delimiter), [])
 
-		fl = open("#part-%s-%s" % (filename, 0), "w+", newline='')
-		writer = csv.writer(fl, delimiter=delimiter)
+		offsets = [header_end] + offsets[1:] + [file_size]
+		self.splits = [(start, end) for start, end in zip(offsets, offsets[1:]) if start < end]
 
-		current_limit = row_limit
-		current_part = 1
-		for i, row in enumerate(reader):
-			if i + 1 > current_limit:
-				current_part += 1
-				current_limit = row_limit * current_part
-				fl = open("#part-%s-%s" % (filename, current_part-1), "w+", newline='')
-				writer = csv.writer(fl, delimiter=delimiter)
-			writer.writerow(row)
+	"""
+	Scan the csv file once and return, for every target offset, the offset
+	right after the first newline at or past the target that ends a row.
+	Newlines inside quoted fields are skipped by tracking the parity of the
+	quote characters seen so far (an escaped "" toggles it twice).
+	Targets that fall inside an already returned row are skipped.
+	"""
+	def csv_row_offsets(self, targets):
+		offsets = []
+		quoted = False
+		seeking = False
+		pos = 0
+		t = 0
+		with open(self.file, "rb") as fl:
+			while t < len(targets):
+				block = fl.read(MapReduce.scan_block_size)
+				if not block:
+					break
+				i = 0
+				while i < len(block) and t < len(targets):
+					if not seeking:
+						j = targets[t] - pos
+						if j >= len(block):
+							break
+						j = max(j, i)
+						quoted ^= block.count(b'"', i, j) & 1
+						i = j
+						seeking = True
+					else:
+						nl = block.find(b'\n', i)
+						if nl < 0:
+							break
+						quoted ^= block.count(b'"', i, nl) & 1
+						i = nl + 1
+						if not quoted:
+							offsets.append(pos + i)
+							seeking = False
+							while t < len(targets) and targets[t] < pos + i:
+								t += 1
+				quoted ^= block.count(b'"', i) & 1
+				pos += len(block)
+		return offsets
 
 	"""
-	Partition a json file into smaller chunks.
-	TODO: Think of a better way to achieve this.
+	Partition a json file into smaller chunks. The file is expected to
+	hold one JSON document per line. The chunks are (start, end) byte
+	ranges that end right after a newline; nothing is parsed here.
 	"""
 	def __partition_json(self):
-		filename = MapReduce.get_filename(self.file)
-		logging.info('Partitioning ' + filename + \
-			 ' into ' + str(self.num_processes) + ' chunks.')
-
-		# load the json file into a list.
-		tweet_list = self.__load(self.file)
-		chunks = self.split_list(tweet_list, self.num_processes)
-		# the number of chunks is equal to the number of processes.
-		j = 0
-		for ch in chunks:
-			fl = open("#part-%s-%s" % (filename, j), "w+")
-			json.dump(ch, fl)
-			fl.close()
-			j+=1
+		logging.info('Partitioning ' + MapReduce.get_filename(self.file) + \
+			 ' into ' + str(self.num_chunks()) + ' chunks.')
+		self.splits = self.split_offsets(MapReduce.newline)
 
+	"""
+	Partition a record file into chunks of whole frames. The frame
+	offsets are read from the frame headers, nothing is decoded.
+	"""
+	def __partition_records(self):
+		offsets = RecordReader.frame_offsets(self.file)
+		self.splits = []
+		for offset in offsets:
+			if not self.splits or offset - self.splits[-1][0] >= self.split_bytes:
+				self.splits.append([offset, None])
+		for n, split in enumerate(self.splits):
+			split[1] = self.splits[n + 1][0] if n + 1 < len(self.splits) else os.path.getsize(self.file)
+		self.splits = [tuple(split) for split in self.splits]
+		logging.info('Partitioning ' + MapReduce.get_filename(self.file) + \
+			' into ' + str(len(self.splits)) + ' chunks of whole frames.')
 
 	"""
-	Load a file into a json object list.
-	Must be changed. Consider ijson external module
-	to do a better json parsing.
+	Lazily parse the JSON documents in the [start, end) byte range
+	of the file, one line at a time. With json_where, a line missing the
+	raw text of a condition (see json_needles) is skipped without being
+	decoded or parsed, and the parsed documents that don't match are
+	dropped. With json_fields, the documents are projected to them.
 	"""
-	def __load(self, json_file):
-		tweet_list = []
-		for tweet in open(json_file):
-			tweet_list.append(json.loads(tweet))
-		return tweet_list
+	def json_records(self, start, end):
+		where = [(field.split('.'), condition) for field, condition in (self.json_where or {}).items()]
+		needles = self.json_needles()
+		fields = [field.split('.') for field in self.json_fields] if self.json_fields else None
+		with io.BufferedReader(FileRange(self.file, start, end)) as fl:
+			for line in fl:
+				if not line.strip():
+					continue
+				if not all(needle in line for needle in needles):
+					self.task_stats['json_lines_skipped'] += 1
+					continue
+				record = json.loads(line)
+				if not all(MapReduce.json_match(record, path, condition) for path, condition in where):
+					self.task_stats['json_records_filtered'] += 1
+					continue
+				yield MapReduce.json_project(record, fields) if fields else record
 
 	"""
-	Split a list into n chunks.
+	Return the byte strings that must appear in the raw line of every
+	document matching json_where: the keys of the conditions and their
+	string and null values as JSON encodes them. Encoders differ in what
+	they escape (non-ASCII, '/', and '&', '<', '>' or "'" in HTML-safe
+	ones), so only strings made of json_plain characters are used.
+	Numbers and booleans never are (5 may be written as 5.0, and True
+	equals 1), so no matching line is ever skipped.
 	"""
-	def split_list(self, lst, n):
-		start = 0
-		for i in range(n):
-		    stop = start + len(lst[i::n])
-		    yield lst[start:stop]
-		    start = stop
+	def json_needles(self):
+		needles = []
+		for field, condition in (self.json_where or {}).items():
+			values = [field.split('.')[-1]]
+			if isinstance(condition, str) or condition is None:
+				values.append(condition)
+			for value in values:
+				if value is None or MapReduce.json_plain.fullmatch(value):
+					needles.append(json.dumps(value).encode('ascii'))
+		return needles
 
+	"""
+	Return whether the document has the field at the given path and its
+	value equals condition (or the callable condition returns true for it).
+	"""
+	@classmethod
+	def json_match(cls, record, path, condition):
+		for name in path:
+			if not isinstance(record, dict) or name not in record:
+				return False
+			record = record[name]
+		return condition(record) if callable(condition) else record == condition
 
 	"""
-	Plays the role of the master node in our framework.
-	Creates a pool of worker processes and assigns mappers. Runs the 
-	intermediate grouping stage for each map result. The number of created chunks 
-	is based on  #number-of-processes. The total number of processes in the 
-	program will be #number-of-processes * #number-of-processes.
+	Return a copy of the document that holds only the fields at the given
+	paths (those it has), nested like in the document.
 	"""
-	def run_master(self):
+	@classmethod
+	def json_project(cls, record, fields):
+		projection = {}
+		for path in fields:
+			value = record
+			for name in path:
+				if not isinstance(value, dict) or name not in value:
+					break
+				value = value[name]
+			else:
+				target = projection
+				for name in path[:-1]:
+					target = target.setdefault(name, {})
+				target[path[-1]] = value
+		return projection
+
+
+"""
+A map task: the chunk #index of file, the [start, end) byte range in it,
+and the parsed header row for csv files (None otherwise).
+"""
+Split = namedtuple('Split', 'file index start end header')
+
+
+"""
+Class FileRange.
+
+A raw binary stream over the [start, end) byte range of a file. Wrapped
+into io.BufferedReader and io.TextIOWrapper it behaves like a regular text
+file that ends at the end of the range, so a chunk can be handed to the
+mapper without copying it into a temporary file first.
+"""
+class FileRange(io.RawIOBase):
+
+	def __init__(self, path, start, end):
+		self.fl = open(path, "rb")
+		self.fl.seek(start)
+		self.remaining = end - start
+
+	def readable(self):
+		return True
+
+	def readinto(self, buff):
+		size = min(len(buff), self.remaining)
+		if size <= 0:
+			return 0
+		n = self.fl.readinto(memoryview(buff)[:size])
+		self.remaining -= n
+		return n
+
+	def close(self):
+		self.fl.close()
+		super(FileRange, self).close()
+
+
+"""
+Class PickleCodec.
+
+Encodes a batch of records with pickle. Supports any picklable record.
+"""
+class PickleCodec:
+
+	def encode(self, records):
+		return pickle.dumps(records, pickle.HIGHEST_PROTOCOL)
+
+	def decode(self, data):
+		return pickle.loads(data)
+
+
+"""
+Class MarshalCodec.
+
+Encodes a batch of records with marshal. Much cheaper than pickle but
+only supports built-in types (str, bytes, int, float, tuple, list, dict).
+"""
+class MarshalCodec:
+
+	def encode(self, records):
+		return marshal.dumps(records)
+
+	def decode(self, data):
+		return marshal.loads(data)
+
+
+"""
+The codecs that intermediate files can be written with. New codecs can be
+plugged in by adding an object with encode(records) and decode(data)
+methods under a new name.
+"""
+record_codecs = {'pickle': PickleCodec(), 'marshal': MarshalCodec()}
+
+
+"""
+The stdlib compressions that the frames of intermediate files can be
+compressed with: name -> (compress(data, level), decompress(data)).
+"""
+record_compressions = {
+	'zlib': (lambda data, level: zlib.compress(data, -1 if level is None else level), zlib.decompress),
+	'lzma': (lambda data, level: lzma.compress(data, preset=level), lzma.decompress),
+	'bz2': (lambda data, level: bz2.compress(data, 9 if level is None else level), bz2.decompress),
+}
+
+
+"""
+Class RecordWriter.
 
-		logging.info('Creating a pool of ' + str(self.num_processes) + ' subprocess workers.')
-		# create a pool of processes.
-		pool = Pool(processes=self.num_processes,)
+Writes records to an intermediate file in a framed binary format. The file
+starts with a header naming the codec and the compression, followed by
+frames. Each frame is a 4-byte big-endian length and a payload holding one
+encoded (and optionally compressed) batch of records, so a file is written
+and read incrementally, one batch at a time.
+
+stats: an optional Counter the byte, record and time counters are added to.
+"""
+class RecordWriter:
+
+	magic = b'MRR2'
+	frame_header = struct.Struct('>I')
+
+	def __init__(self, path, codec='pickle', batch_size=1024, compression=None, level=None, stats=None):
+		if codec not in record_codecs:
+			raise MapReduceError("Unknown record codec " + str(codec) + ".")
+		if compression is not None and compression not in record_compressions:
+			raise MapReduceError("Unknown compression " + str(compression) + ".")
+		self.codec = record_codecs[codec]
+		self.compress = record_compressions[compression][0] if compression else None
+		self.level = level
+		self.stats = Counter() if stats is None else stats
+		self.batch_size = batch_size
+		self.batch = []
+		self.fl = open(path, "wb")
+		header = RecordWriter.magic
+		for name in (codec, compression or ''):
+			name = name.encode('ascii')
+			header += bytes([len(name)]) + name
+		self.fl.write(header)
+		self.stats['bytes_written'] += len(header)
+
+	def write(self, record):
+		self.batch.append(record)
+		if len(self.batch) >= self.batch_size:
+			self.flush()
+
+	def flush(self):
+		if self.batch:
+			start = time.perf_counter()
+			payload = self.codec.encode(self.batch)
+			self.stats['serialize_time'] += time.perf_counter() - start
+			self.stats['records_written'] += len(self.batch)
+			self.stats['raw_bytes_written'] += len(payload)
+			if self.compress is not None:
+				start = time.perf_counter()
+				payload = self.compress(payload, self.level)
+				self.stats['compress_time'] += time.perf_counter() - start
+			self.fl.write(RecordWriter.frame_header.pack(len(payload)))
+			self.fl.write(payload)
+			self.stats['bytes_written'] += RecordWriter.frame_header.size + len(payload)
+			self.batch = []
+
+	def close(self):
+		self.flush()
+		self.fl.close()
 
-		# apply map on the chunks in parallel.
-		regions = pool.map(self.apply_map, range(0, self.num_processes))
 
-		# do the intermediate grouping step on each chunks in parallel.
-		inters = pool.map(self.apply_intermediate, range(0, self.num_processes))
+"""
+Class RecordReader.
+
+Iterates over the records of a file written by RecordWriter, decoding one
+frame at a time. start and end (frame offsets, see frame_offsets) restrict
+the reader to a part of the file.
+
+stats: an optional Counter the byte, record and time counters are added to.
+"""
+class RecordReader:
+
+	def __init__(self, path, start=None, end=None, stats=None):
+		self.path = path
+		self.start = start
+		self.end = end
+		self.stats = Counter() if stats is None else stats
+
+	"""
+	Read the header of the file. Return the codec, the decompress function
+	(or None) and the offset of the first frame.
+	"""
+	@classmethod
+	def read_header(cls, fl):
+		magic = fl.read(len(RecordWriter.magic))
+		if magic != RecordWriter.magic:
+			raise MapReduceError("Not a record file.")
+		codec = fl.read(fl.read(1)[0]).decode('ascii')
+		compression = fl.read(fl.read(1)[0]).decode('ascii')
+		decompress = record_compressions[compression][1] if compression else None
+		return record_codecs[codec], decompress, fl.tell()
+
+	"""
+	Return the offsets of all frames in the file. The file is scanned
+	through mmap and only the frame headers are touched, nothing is decoded.
+	"""
+	@classmethod
+	def frame_offsets(cls, path):
+		with open(path, "rb") as fl:
+			codec, decompress, pos = RecordReader.read_header(fl)
+			size = os.fstat(fl.fileno()).st_size
+			if pos == size:
+				return []
+			offsets = []
+			with mmap.mmap(fl.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+				while pos < size:
+					offsets.append(pos)
+					length, = RecordWriter.frame_header.unpack_from(mm, pos)
+					pos += RecordWriter.frame_header.size + length
+			return offsets
+
+	def __iter__(self):
+		with open(self.path, "rb") as fl:
+			codec, decompress, pos = RecordReader.read_header(fl)
+			if self.start is not None:
+				fl.seek(self.start)
+				pos = self.start
+			while self.end is None or pos < self.end:
+				header = fl.read(RecordWriter.frame_header.size)
+				if not header:
+					return
+				length, = RecordWriter.frame_header.unpack(header)
+				pos += RecordWriter.frame_header.size + length
+				payload = fl.read(length)
+				self.stats['bytes_read'] += RecordWriter.frame_header.size + length
+				if decompress is not None:
+					start = time.perf_counter()
+					payload = decompress(payload)
+					self.stats['decompress_time'] += time.perf_counter() - start
+				start = time.perf_counter()
+				records = codec.decode(payload)
+				self.stats['deserialize_time'] += time.perf_counter() - start
+				self.stats['records_read'] += len(records)
+				for record in records:
+					yield record
 
 
 """
@@ -345,21 +1100,187 @@ Class MapReduceInterface.
 The main class interface that directly talks to the user defined class.
 
 This class takes user input files, mapper and reducer 
-functions and creates MapReduce job on each single file. 
-Please note that MapReduce class object takes only one file 
-as a field. All under the hood operations are hidden from the 
-user and handled by the framework itself. In the beginning, 
-the class creates a pool of processes such that one process is
-assigned to one file. Then, for each file one MapReduce object is 
-created where the number of processes is equal to the total number of files. 
-All MapReduce jobs for different files are run in parallel. 
+functions and runs one MapReduce job on all the files. 
+All under the hood operations are hidden from the 
+user and handled by the framework itself. A single pool of worker
+processes runs every task: the partitioning of each file, one map task
+per chunk of every file and one reduce task per partition.
 """
 class MapReduceInterface(MapReduce):
 
 	"""
-	The framework supports these 3 file formats yet. 
+	The framework supports these 3 file formats yet, plus its own record
+	files (.mrr) written by a job with output_format 'records'.
+	"""
+	supported_file_types = ('txt', 'json', 'csv', 'mrr')
+
+	"""
+	The output of the job. output is the file the results are written to,
+	one per line in output_format: 'text' (the str() of every result),
+	'tsv', 'jsonl' or 'csv', or 'records' to write them as a record file in
+	the intermediate format that another job can read without parsing
+	text, see JobChain. Every reducer writes its own part; by default
+	the parts are concatenated into output. With output_parts, output is
+	a directory holding the parts and a manifest listing them instead.
+	With sort_output the results are sorted by output_sort_key (a method
+	or callable taking a result, None to sort by the results themselves):
+	within every part, and globally when the parts are merged into one file.
+	"""
+	supported_output_formats = ('text', 'tsv', 'jsonl', 'csv', 'records')
+	output_extensions = {'text': 'txt', 'tsv': 'tsv', 'jsonl': 'json', 'csv': 'csv', 'records': 'mrr'}
+	output = 'map_reduce_output.txt'
+	output_format = 'text'
+	output_parts = False
+	sort_output = False
+	output_sort_key = None
+
+	"""
+	Predicate pushdown and projection for json input. json_where maps a
+	field to the value it must equal, or to a callable taking the value
+	and returning whether the document matches; only the documents that
+	have every field and match every condition reach the mapper.
+	json_fields lists the fields the mapper needs, and every document is
+	cut down to them. A field of a nested object is named by its dotted
+	path, e.g. 'user.lang'. Before a line is parsed, the raw line is
+	searched for the keys of json_where and its plain string and null
+	values (see json_needles), and lines missing any of them are skipped
+	unparsed.
 	"""
-	supported_file_types = ('txt', 'json', 'csv')
+	json_where = None
+	json_fields = None
+
+	"""
+	The memory budget of the grouping stage: the number of (key, value)
+	pairs buffered in memory before a sorted run is spilled to disk.
+	"""
+	spill_threshold = 100000
+
+	"""
+	The optional combiner defined by user. It has the same signature as
+	the reducer: takes (key, values) pairs and returns or yields
+	(key, value) pairs. It runs inside the map task and on every spill to
+	pre-aggregate the map output, so it must be safe to apply it any number
+	of times (e.g. summing counts).
+	"""
+	combiner = None
+
+	"""
+	The codec used to serialize the records of the intermediate files,
+	one of the names registered in record_codecs. 'marshal' is faster
+	than 'pickle' but only supports the built-in types.
+	"""
+	intermediate_codec = 'pickle'
+
+	"""
+	The optional compression of the intermediate files: None, 'zlib', 'lzma'
+	or 'bz2'. Either one name for all stages, or a dict mapping a stage
+	('map' for the sorted runs, 'reduce' for the reduce results) to a name.
+	Every frame is compressed on its own at compression_level (None means
+	the default level of the codec), so files are still streamed.
+	"""
+	intermediate_compression = None
+	compression_level = None
+
+	"""
+	The planner of the job. The number of processes is the number of CPUs
+	as long as each worker can get worker_memory bytes. The input is split
+	into chunks of split_size bytes at most, but never smaller than
+	min_split_size so small inputs don't turn into a swarm of tiny tasks.
+	"""
+	worker_memory = 256 * 1024 * 1024
+	split_size = 64 * 1024 * 1024
+	min_split_size = 1024 * 1024
+
+	"""
+	Speculative execution of stragglers: a map or reduce task running for
+	more than speculation_factor times the median task duration of its
+	phase (and at least speculation_min_time seconds) gets a duplicate
+	attempt, and the first attempt to finish wins.
+	"""
+	speculative_execution = True
+	speculation_factor = 2.0
+	speculation_min_time = 1.0
+
+	"""
+	Skew handling. The map output is hashed into partitions_per_reducer
+	partitions per reducer, which are then balanced over the reducers by
+	their sampled sizes. Every map task reports its hot_key_sample keys
+	with the most values.
+	"""
+	partitions_per_reducer = 8
+	hot_key_sample = 10
+
+	"""
+	Checkpointing. The finished tasks of a job are recorded in a manifest
+	and their outputs are named after a digest of their inputs. If a run
+	fails, rerunning the same job skips every task that already finished.
+	"""
+	resumable = True
+
+	"""
+	Incremental recomputation. If cache_dir is set, the output of every
+	map task is kept there, keyed by the path, size and modification time
+	of its input, the code of the mapper, combiner and partitioner and the
+	parameters of the job. A later job over unchanged files takes the
+	output from the cache instead of mapping them again. The least
+	recently used entries are removed once the cache grows over cache_size
+	bytes.
+	"""
+	cache_dir = None
+	cache_size = 1024 * 1024 * 1024
+
+	"""
+	The directories the temporary files of a job are written to, e.g. a
+	tmpfs or local NVMe mount. Every job gets its own work directory in
+	each of them, and the output of the tasks is spread over them.
+	"""
+	scratch_dirs = ['.']
+
+	"""
+	Pipelining. While the map tasks are still running, the runs of every
+	merge_fan_in finished map tasks are merged into one run per partition
+	by a merge task (through the combiner, if any), so the merging of the
+	map output overlaps with the map phase and the reducers start with
+	fewer, bigger runs. Set merge_fan_in to 0 to turn it off.
+	"""
+	merge_fan_in = 8
+
+	"""
+	The JSON file the metrics of every run are written to, if any. The
+	metrics are returned by run_program either way.
+	"""
+	metrics_file = None
+
+	"""
+	Profiling of user code and of the framework inside the workers.
+	profile names the profilers to run: 'cprofile' and/or 'tracemalloc'.
+	A stable profile_sample fraction of the tasks is profiled, each into
+	its own file in profile_dir, and the profile_top entries of all of
+	them are aggregated into profile_dir/report.txt. profile_frames is
+	the number of frames tracemalloc keeps per allocation.
+	"""
+	profile = ()
+	profile_sample = 0.1
+	profile_dir = 'map_reduce_profile'
+	profile_top = 20
+	profile_frames = 1
+
+	"""
+	The state only the master uses, which grows with the number of tasks
+	and of input files. It is left out of the job pickled with every task sent to the workers
+	(see __getstate__), so dispatching a task costs the same however many
+	tasks ran before it.
+	"""
+	master_state = ('files', 'manifest', 'stats', 'task_metrics', 'phase_times', 'metrics', 'merged', \
+		'map_task_ids', 'reduce_task_ids')
+
+	"""
+	The attributes the framework itself sets on a job. Like the options
+	of the framework, they are not parameters of the job (see job_params).
+	"""
+	job_state = ('params', 'job_id', 'work_dir', 'work_dirs', 'num_processes', 'num_partitions', \
+		'split_bytes', 'splits', 'file', 'file_ext', 'header', 'combined', 'run_sources', \
+		'counters', 'task_stats', 'sample', 'lock_content')
 
 
 	"""
@@ -369,8 +1290,7 @@ class MapReduceInterface(MapReduce):
 	"""
 	def __init__(self, mapper, reducer, files):
 
-		logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p', 
-			filename='map_reduce.log',level=logging.INFO)
+		configure_logging()
 
 		mapper = self.mapper
 		reducer = self.reducer
@@ -378,15 +1298,27 @@ class MapReduceInterface(MapReduce):
 
 		self.files = files
 		self.num_processes = self.__set_num_processes()
+		self.counters = Counter()
 
 		# make sure that the user input is valid.
 		self.__files_not_empty()
 		self.__the_same_format_files()
 		self.__is_file_format_supported()
 		self.__check_file_names()
+		self.__is_output_format_supported()
 
 		logging.info('All user input validations are passed. We are set to go!')
 
+	"""
+	Return the state of the job pickled for the workers, without the
+	master_state.
+	"""
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		for name in self.master_state:
+			state.pop(name, None)
+		return state
+
 	"""
 	Check that at least one file is given as input.
 	"""
@@ -412,7 +1344,15 @@ class MapReduceInterface(MapReduce):
 			ext = MapReduce.get_file_extension(f)
 			if ext not in MapReduceInterface.supported_file_types:
 				self.__cleanup()
-				raise MapReduceError("Currently framework supports txt, json and csv files only.")
+				raise MapReduceError("Currently framework supports txt, json, csv and mrr files only.")
+
+	"""
+	The output format must be one the framework can write.
+	"""
+	def __is_output_format_supported(self):
+		if self.output_format not in MapReduceInterface.supported_output_formats:
+			self.__cleanup()
+			raise MapReduceError("Currently framework writes text, tsv, jsonl, csv and records output only.")
 
 	"""
 	All input files must have the same file extension.. 
@@ -447,23 +1387,346 @@ class MapReduceInterface(MapReduce):
 				raise MapReduceError("All files must have unique names.")
 
 	"""
-	Based on the number of files this method sets 
-	the number of processes used in the framework.
-	If the number of files is less than 3 then we
-	assign num_processes = 3 (the best threshold we found). 
+	Based on the machine this method sets the number of processes used
+	in the framework: one per CPU, as long as every worker can get
+	worker_memory bytes of the available memory. The number of reduce
+	partitions is the same as the number of processes.
 	"""
 	def __set_num_processes(self):
-		if len(self.files) < 3:
-			return 3
-		return len(self.files)
+		num_processes = os.cpu_count() or 1
+		memory = MapReduceInterface.available_memory()
+		if memory is not None:
+			num_processes = min(num_processes, memory // self.worker_memory)
+		return max(1, num_processes)
+
+	"""
+	Return the number of bytes of memory available to new processes,
+	or None if it can't be told on this platform.
+	"""
+	@classmethod
+	def available_memory(cls):
+		try:
+			with open('/proc/meminfo') as fl:
+				for line in fl:
+					if line.startswith('MemAvailable:'):
+						return int(line.split()[1]) * 1024
+		except OSError:
+			pass
+		try:
+			return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+		except (ValueError, OSError, AttributeError):
+			return None
+
+	"""
+	Pick the size of the chunks the files are split into: the total input
+	is spread evenly over the workers, but a chunk is never bigger than
+	split_size or smaller than min_split_size.
+	With a cache the chunks are always split_size big, so changing one
+	file doesn't move the chunks of the others.
+	"""
+	def plan_split_size(self):
+		if self.cache_dir is not None:
+			return self.split_size
+		total_size = sum(os.path.getsize(f) for f in self.files)
+		per_worker = -(-total_size // self.num_processes)
+		return max(self.min_split_size, min(self.split_size, per_worker))
+
+	"""
+	Group the splits of all files into map tasks. Splits are packed in
+	order into one task as long as the task stays within split_bytes, so
+	many small files don't end up as many tiny tasks. With a cache the
+	splits of different files are never packed together, so every task
+	only depends on a single file.
+	Returns a list of (task id, [splits], cache key) triples. The task id
+	is a digest of the job and of the splits, including the size and
+	modification time of their files, so it changes whenever the input of
+	the task does. The cache key is None when there's no cache.
+	"""
+	def plan_map_tasks(self, splits):
+		groups = []
+		task_size = 0
+		for split in splits:
+			size = split.end - split.start
+			if not groups or task_size + size > self.split_bytes or \
+				(self.cache_dir is not None and groups[-1][-1].file != split.file):
+				groups.append([])
+				task_size = 0
+			groups[-1].append(split)
+			task_size += size
+
+		tasks = []
+		for group in groups:
+			inputs = [(os.path.abspath(split.file), split.start, split.end, MapReduceInterface.fingerprint(split.file)) \
+				for split in group]
+			t = MapReduceInterface.digest(self.job_id, inputs)
+			cache_key = None
+			if self.cache_dir is not None:
+				cache_key = MapReduceInterface.digest(self.cache_digest(), inputs)
+			tasks.append((t, group, cache_key))
+		return tasks
+
+	"""
+	The followup of the map tasks: once merge_fan_in map tasks finished
+	whose runs are not merged yet, return a merge task for them. The
+	batches are kept in the manifest, so a resumed job merges the same
+	batches and finds their outputs again.
+	"""
+	def plan_merge_tasks(self, phase, t):
+		if phase != 'map' or self.merge_fan_in < 2:
+			return []
+		finished = set(self.manifest['tasks']['map'])
+		batches = self.manifest.setdefault('merge_batches', [])
+		current = set(self.map_task_ids)
+		batched = set(u for batch in batches if current.issuperset(batch) for u in batch)
+		if t not in batched:
+			unmerged = [u for u in self.manifest['tasks']['map'] if u in current and u not in batched]
+			if len(unmerged) >= self.merge_fan_in:
+				batches.append(unmerged[:self.merge_fan_in])
+
+		for batch in batches:
+			if t in batch and finished.issuperset(batch) and current.issuperset(batch):
+				m = MapReduceInterface.digest(self.job_id, 'merge', batch)
+				if m in self.merged:
+					return []
+				self.merged[m] = batch
+				return [('merge', self.apply_merge, (m, batch))]
+		return []
+
+	"""
+	Return the part of the cache key that doesn't depend on the input:
+	the job class, its parameters, the code of its mapper, combiner and
+	partitioner and the layout of its map output.
+	"""
+	def cache_digest(self):
+		code = [MapReduceInterface.code_digest(func) for func in (self.mapper, self.combiner, self.partitioner)]
+		return (type(self).__name__, self.params, code, self.json_digest(), self.num_partitions, \
+			self.intermediate_codec, self.intermediate_compression, self.compression_level)
+
+	"""
+	Remove the least recently used entries of the cache until it holds
+	at most cache_size bytes.
+	"""
+	def evict_cache(self):
+		entries = []
+		total_size = 0
+		for entry in os.scandir(self.cache_dir):
+			if not entry.is_dir() or '.tmp-' in entry.name:
+				continue
+			size = sum(f.stat().st_size for f in os.scandir(entry.path))
+			entries.append((entry.stat().st_mtime, size, entry.path))
+			total_size += size
+		for last_used, size, path in sorted(entries):
+			if total_size <= self.cache_size:
+				break
+			shutil.rmtree(path, ignore_errors=True)
+			total_size -= size
+
+	"""
+	Return a short hex digest of the repr of the given values.
+	"""
+	@classmethod
+	def digest(cls, *values):
+		return hashlib.sha1(repr(values).encode('utf-8')).hexdigest()[:16]
+
+	"""
+	Return the (size, modification time) fingerprint of a file.
+	"""
+	@classmethod
+	def fingerprint(cls, path):
+		st = os.stat(path)
+		return (st.st_size, st.st_mtime_ns)
+
+	"""
+	Return a digest of the code of a user defined function (or None),
+	so changing the mapper or the reducer changes the job id.
+	"""
+	@classmethod
+	def code_digest(cls, func):
+		if func is None:
+			return None
+		func = getattr(func, '__func__', func)
+		if not hasattr(func, '__code__'):
+			return repr(func)
+		return hashlib.sha1(marshal.dumps(func.__code__)).hexdigest()
+
+	"""
+	Return the json_where and json_fields of the job for its digests, with
+	the code digest of every callable condition in place of the callable.
+	"""
+	def json_digest(self):
+		where = sorted((field, MapReduceInterface.code_digest(condition) if callable(condition) else repr(condition)) \
+			for field, condition in (self.json_where or {}).items())
+		return (where, self.json_fields)
+
+	"""
+	Return the parameters of the job as a string for its digests: the
+	attributes set on the job (e.g. Twitter's attr) and the class
+	attributes of the user classes (e.g. a threshold the mapper reads),
+	whenever they were set. Functions are represented by a digest of their
+	code. The options of the framework and its own state are left out;
+	the options that change the map output are part of the digests anyway.
+	The reducer is left out too, see job_digest.
+	"""
+	def job_params(self):
+		params = {}
+		for cls in type(self).__mro__:
+			if cls in MapReduceInterface.__mro__:
+				continue
+			for name, value in vars(cls).items():
+				params.setdefault(name, value)
+		params.update(vars(self))
+		excluded = self.job_state + self.master_state + ('reducer',)
+		return repr(sorted((name, MapReduceInterface.code_digest(value) if callable(value) or hasattr(value, '__func__') \
+			else repr(value)) for name, value in params.items() if not name.startswith('__') \
+			and name not in excluded and not hasattr(MapReduceInterface, name)))
+
+	"""
+	Return the id of the job: a digest of the job class, its parameters,
+	its mapper, combiner and partitioner, its input files and the options
+	that change the layout of the intermediate files. Rerunning the same
+	job gives the same id, so it finds the work directory of a previous
+	run. The reducer is left out so that fixing a failing reducer keeps
+	the map outputs; it is part of the ids of the reduce tasks instead.
+	"""
+	def job_digest(self):
+		code = [MapReduceInterface.code_digest(func) for func in (self.mapper, self.combiner, self.partitioner)]
+		options = (self.num_processes, self.partitions_per_reducer, self.split_size, self.min_split_size, \
+			self.intermediate_codec, self.intermediate_compression)
+		return MapReduceInterface.digest(type(self).__name__, self.params, code, self.json_digest(), options, \
+			[os.path.abspath(f) for f in self.files])
+
+	"""
+	Create the work directories of the job, one per scratch directory,
+	and lock them with a lock file holding our pid and a token of this
+	run. The job id names the directories, so a rerun of a failed job
+	finds them again. If the same job is running right now (its pid is
+	alive), this run gets directories of its own instead; a lock left by
+	a crashed run is taken over. The first directory (self.work_dir) holds
+	the lock and the manifest. The lock is written to a temporary file
+	which is then hard linked to the lock, so the lock never exists
+	without its content, and a lock is only ever removed by remove_lock.
+	"""
+	def lock_work_dirs(self):
+		scratch_dirs = self.scratch_dirs
+		if isinstance(scratch_dirs, str):
+			scratch_dirs = [scratch_dirs]
+		self.lock_content = '%d %s' % (os.getpid(), uuid.uuid4().hex)
+		while True:
+			self.work_dirs = [os.path.join(scratch_dir, "#job-" + self.job_id) for scratch_dir in scratch_dirs]
+			self.work_dir = self.work_dirs[0]
+			for work_dir in self.work_dirs:
+				os.makedirs(work_dir, exist_ok=True)
+			lock = os.path.join(self.work_dir, 'lock')
+			lock_tmp = lock + '.tmp-' + uuid.uuid4().hex
+			with open(lock_tmp, 'w') as fl:
+				fl.write(self.lock_content)
+			try:
+				os.link(lock_tmp, lock)
+			except FileExistsError:
+				try:
+					with open(lock) as fl:
+						content = fl.read()
+					pid = int(content.split()[0])
+				except FileNotFoundError:
+					continue
+				except (OSError, ValueError, IndexError):
+					# not written by lock_work_dirs, so don't take it over.
+					pid = None
+				if pid is None or MapReduceInterface.process_alive(pid):
+					logging.info('The job ' + self.job_id + ' is already running; using separate work directories.')
+					self.job_id += '-' + uuid.uuid4().hex[:8]
+				else:
+					logging.info('Taking over the work directories of a crashed run.')
+					MapReduceInterface.remove_lock(lock, content)
+				continue
+			finally:
+				os.remove(lock_tmp)
+			return
+
+	"""
+	Remove the lock if it still holds the given content. The lock is first
+	renamed to a name of our own, which only one run can do, and checked
+	there: if another run took the lock in the meantime, it is linked back.
+	"""
+	@classmethod
+	def remove_lock(cls, lock, content):
+		claimed = lock + '.claimed-' + uuid.uuid4().hex
+		try:
+			os.rename(lock, claimed)
+		except FileNotFoundError:
+			return
+		try:
+			with open(claimed) as fl:
+				if fl.read() != content:
+					try:
+						os.link(claimed, lock)
+					except FileExistsError:
+						pass
+		finally:
+			os.remove(claimed)
+
+	"""
+	Return whether a process with the given pid is running.
+	"""
+	@classmethod
+	def process_alive(cls, pid):
+		try:
+			os.kill(pid, 0)
+		except ProcessLookupError:
+			return False
+		except PermissionError:
+			return True
+		return True
+
+	"""
+	Load the manifest of the job from its work directory: for every phase
+	the ids of the tasks that finished. Empty for a fresh job.
+	"""
+	def load_manifest(self):
+		try:
+			with open(os.path.join(self.work_dir, 'manifest.json')) as fl:
+				return json.load(fl)
+		except (OSError, ValueError):
+			return {'job': self.job_id, 'tasks': {}}
+
+	"""
+	Atomically write the manifest of the job.
+	"""
+	def save_manifest(self):
+		path = os.path.join(self.work_dir, 'manifest.json')
+		with open(path + '.tmp', 'w') as fl:
+			json.dump(self.manifest, fl)
+		os.replace(path + '.tmp', path)
+
+	"""
+	Return whether the given task finished in this or a previous run
+	of the job and its output is still there.
+	"""
+	def task_finished(self, phase, t):
+		return t in self.manifest['tasks'].get(phase, ()) and os.path.exists(self.task_path(phase, t))
+
+	"""
+	Remove what a crashed attempt of the task may have left behind:
+	its done marker without an output, and its attempt outputs.
+	"""
+	def reset_task(self, phase, t):
+		path = self.task_path(phase, t)
+		for stale in glob.glob(glob.escape(path) + '.attempt-*'):
+			if os.path.isdir(stale):
+				shutil.rmtree(stale)
+			else:
+				os.remove(stale)
+		if os.path.exists(path + '.done') and not os.path.exists(path):
+			os.remove(path + '.done')
 
 	"""
 	Clean all temporary files created during the program
 	execution if any.
 	"""
 	def __cleanup(self):
-		# all temp files start with #.
-		subprocess.call(["/bin/bash", "rm \#*", "shell=False"])
+		# all temp files live in the work directories of the job.
+		for work_dir in getattr(self, 'work_dirs', ()):
+			shutil.rmtree(work_dir, ignore_errors=True)
 
 	"""
 	Finalize the program execution. E.g. print outputs,
@@ -477,42 +1740,110 @@ class MapReduceInterface(MapReduce):
 	"""
 	The main method that runs the whole framwork (program).
 	Must be run by user.
+
+	pool: an optional multiprocessing Pool to run the tasks on, e.g. the
+	one of a JobRunner. By default a pool of num_processes workers is
+	created for this run and closed at the end.
+	Returns the metrics of the job, see job_metrics.
 	"""
-	def run_program(self):
+	def run_program(self, pool=None):
 
 		logging.info('Running the framework...')
 		# Fixing the start time.
 		start_time = time.time()
 
 		"""
-		Create a pool of processes. The number of processes
-		is equal to the number of files. One process takes care of one file.
+		One bounded pool of processes runs every task of the job: the
+		partitioning of the files, the map tasks of all chunks of all files
+		and the reduce tasks. Workers never create pools of their own.
 		"""
-		pool = MyMRPool(len(self.files))
-
-		logging.info('The initial number of running processes is ' + str(len(self.files)) + '.')
-
+		own_pool = pool is None
+		if own_pool:
+			pool = Pool(processes=self.num_processes)
+			logging.info('Created a pool of ' + str(self.num_processes) + ' worker processes.')
 
 		"""
-		Apply call_map_reduce on all files in parallel. All files 
-		will be partitioned/mapped/shuffled individually.
+		All temporary files of the job live in its own work directory, named
+		after the job id. If a previous run of the same job failed, its
+		directory is still there and the finished tasks are reused.
 		"""
-		apply_map_reduces = pool.map(self.call_map_reduce, self.files)
+		self.params = self.job_params()
+		self.job_id = self.job_digest()
+		self.lock_work_dirs()
+		self.manifest = self.load_manifest()
+		if self.cache_dir is not None:
+			os.makedirs(self.cache_dir, exist_ok=True)
+		succeeded = False
+
+		# the wall time of every phase of the job and the metrics of its tasks.
+		self.phase_times = {}
+		self.task_metrics = {}
+		self.counters = Counter()
+		if self.profile:
+			os.makedirs(self.profile_dir, exist_ok=True)
+
+		try:
+			# partition all files in parallel into chunks of split_bytes.
+			phase_start = time.time()
+			self.split_bytes = self.plan_split_size()
+			self.num_partitions = self.num_processes * self.partitions_per_reducer
+			splits = [split for file_splits in pool.map(self.plan_file, self.files) for split in file_splits]
+			tasks = self.plan_map_tasks(splits)
+			self.phase_times['split'] = time.time() - phase_start
 
+			"""
+			Apply map on the chunks of all files in parallel. Every map task
+			groups its output and spills sorted runs for each partition.
+			"""
+			logging.info('Running ' + str(len(tasks)) + ' map tasks over ' + str(len(splits)) + \
+				' chunks of about ' + str(self.split_bytes) + ' bytes.')
+			self.map_task_ids = [task[0] for task in tasks]
+			self.stats = {}
+			self.merged = {}
+			self.stats['map'], samples = self.run_tasks(pool, 'map', self.apply_map, tasks, self.plan_merge_tasks)
+			self.run_sources = [('merge', m) for m in sorted(self.merged)] + \
+				[('map', t) for t in self.map_task_ids if not any(t in batch for batch in self.merged.values())]
+			if self.cache_dir is not None:
+				logging.info('Took ' + str(self.stats['map']['cache_hits']) + ' of ' + str(len(tasks)) + \
+					' map outputs from the cache.')
+				self.evict_cache()
 
-		self.shuffle()
-
-		"""
-		At this point we have bunch of inter-shuffled files.
-		We can reduce them in parallel.	
-		"""
-		reduces = pool.map(self.apply_reduce, range(0, self.num_processes))
+			"""
+			At this point every map task has written its sorted runs
+			into one file per partition. The partitions are balanced over
+			the reducers based on the sampled sizes, and hot partitions are
+			pre-combined in parallel. Each reducer pulls its own partitions.
+			"""
+			combine_tasks, reduce_tasks = self.plan_reduce_tasks(samples)
+			if combine_tasks:
+				self.stats['combine'], samples = self.run_tasks(pool, 'combine', self.apply_combine, combine_tasks)
+			self.reduce_task_ids = [task[0] for task in reduce_tasks]
+			self.stats['reduce'], samples = self.run_tasks(pool, 'reduce', self.apply_reduce, reduce_tasks)
 
-		"""
-		At this point we have bunch of reduced files so we can 
-		merge all reduce files into one final file.	
-		"""
-		self.merge_reduce_results()
+			"""
+			At this point we have bunch of reduced files so we can 
+			merge all reduce files into one final file.	
+			"""
+			phase_start = time.time()
+			self.merge_reduce_results()
+			self.phase_times['output'] = time.time() - phase_start
+			succeeded = True
+		finally:
+			"""
+			Speculative duplicates that lost may still be running. Our own
+			pool is stopped right away; on a shared pool they fail as soon
+			as the work directory is gone. The work directory of a failed
+			run is kept so the job can be resumed by running it again.
+			"""
+			if own_pool:
+				pool.terminate()
+				pool.join()
+			if succeeded or not self.resumable:
+				self.__cleanup()
+			else:
+				MapReduceInterface.remove_lock(os.path.join(self.work_dir, 'lock'), self.lock_content)
+				logging.info('The job failed. Its finished tasks are kept in ' + ', '.join(self.work_dirs) + \
+					'; run it again to resume.')
 
 		"""
 		Finilizing the framework execution.	
@@ -528,102 +1859,440 @@ class MapReduceInterface(MapReduce):
 		end_time = time.time()
 
 		logging.info('The total execution time is: ' + str(end_time - start_time))
+		self.log_stats()
+		self.profile_report()
 
+		self.metrics = self.job_metrics(end_time - start_time)
+		if self.metrics_file is not None:
+			with open(self.metrics_file, 'w') as fl:
+				json.dump(self.metrics, fl, indent=1, default=str)
+		return self.metrics
 
 	"""
-	The shuffle method of the framework. Master process redistributes the data based 
-	on the output keys (produced by the "map()" function), such that all data 
-	belonging to one key is located on the reducer worker.
+	Run the tasks of one phase on the pool and return the sum of their
+	I/O counters. At most num_processes attempts are in flight, so an
+	attempt starts running when it is dispatched. Once every task has been
+	dispatched, a task that has been running for more than
+	speculation_factor times the median duration of the finished tasks of
+	its phase (and at least speculation_min_time seconds) gets one
+	speculative duplicate. Whichever attempt commits first wins.
+	Tasks that finished in a previous run of the job are skipped.
+
+	followup: an optional function called with the phase and the id of
+	every task that finished (or was skipped). It returns a list of
+	(phase, func, task) triples of new tasks that depend on it, which
+	are run on the pool in the same loop, so the phases overlap. Their
+	counters are added to self.stats.
+	Returns the summed counters and a list of the samples of the tasks.
+	"""
+	def run_tasks(self, pool, phase, func, tasks, followup=None):
+		phase_start = time.time()
+		results = queue.Queue()
+		pending = []
+		running = {}
+		durations = defaultdict(list)
+		stats = defaultdict(Counter)
+		samples = []
+		skipped = Counter()
+		in_flight = 0
+
+		def done(task_phase, t):
+			finished = self.manifest['tasks'].setdefault(task_phase, [])
+			if t not in finished:
+				finished.append(t)
+			if followup is not None:
+				for next_task in followup(task_phase, t):
+					schedule(*next_task)
+
+		def schedule(task_phase, task_func, task):
+			if self.resumable and self.task_finished(task_phase, task[0]):
+				skipped[task_phase] += 1
+				if task_phase == phase:
+					samples.append(self.load_sample(task_phase, task[0]))
+				done(task_phase, task[0])
+			else:
+				self.reset_task(task_phase, task[0])
+				pending.append((task_phase, task_func, task))
+
+		def dispatch(task_phase, task_func, task, attempt):
+			pool.apply_async(self.run_task, (task_func, task, attempt),
+				callback=lambda result: results.put((task_phase, result)),
+				error_callback=lambda error: results.put((task_phase, error)))
+			running.setdefault((task_phase, task[0]), [time.time(), task_func, task, 0])[3] += 1
+
+		self.manifest['tasks'].setdefault(phase, [])
+		for task in tasks:
+			schedule(phase, func, task)
+		for task_phase, count in skipped.items():
+			logging.info('Resuming: ' + str(count) + ' ' + task_phase + ' tasks are already done.')
+
+		while pending or running:
+			while pending and in_flight < self.num_processes:
+				dispatch(*pending.pop(0), 0)
+				in_flight += 1
+
+			if not pending and in_flight < self.num_processes and self.speculative_execution:
+				now = time.time()
+				for (task_phase, t), (started, task_func, task, attempts) in list(running.items()):
+					if attempts > 1 or not durations[task_phase]:
+						continue
+					median = sorted(durations[task_phase])[len(durations[task_phase]) // 2]
+					if now - started > max(self.speculation_min_time, self.speculation_factor * median):
+						logging.info('The ' + task_phase + ' task #' + str(t) + ' is a straggler. Launching a speculative attempt.')
+						dispatch(task_phase, task_func, task, 1)
+						in_flight += 1
+						if in_flight >= self.num_processes:
+							break
+
+			try:
+				task_phase, result = results.get(timeout=0.1)
+			except queue.Empty:
+				continue
+			in_flight -= 1
+			if isinstance(result, BaseException):
+				# let the attempts still running finish first: a worker killed by
+				# pool.terminate() while it sends its result leaves the result
+				# queue of the pool locked, and terminate() waits on it forever.
+				for n in range(in_flight):
+					results.get()
+				raise result
+			t, won, task_stats, sample, metrics = result
+			if won:
+				durations[task_phase].append(time.time() - running.pop((task_phase, t))[0])
+				stats[task_phase].update(task_stats)
+				if task_phase == phase:
+					samples.append(sample)
+				self.task_metrics.setdefault(task_phase, []).append(metrics)
+				self.counters.update(metrics['counters'])
+				done(task_phase, t)
+				self.save_manifest()
+
+		# the tasks of the other phases overlapped with this one; their time is the sum of their durations.
+		self.phase_times[phase] = time.time() - phase_start
+		for task_phase in stats:
+			if task_phase != phase:
+				self.stats.setdefault(task_phase, Counter()).update(stats[task_phase])
+				self.phase_times[task_phase] = sum(durations[task_phase])
+		return stats[phase], samples
 
-	TODO:
-	1. Can we do more memory efficient shuffle?
 	"""
-	def shuffle(self):
-		logging.info('Master started the shuffle phase.') 
-		dic = defaultdict(list)
-		for filepath in self.files:
-			filename = MapReduce.get_filename(filepath)
-			for i in range(0, self.num_processes):
-				fl = open("#inter-%s-%s" % (filename, i), "rb")
-				chunk_dic = pickle.load(fl)
-				for key in chunk_dic.keys():
-					if key in dic:
-						dic[key] += chunk_dic[key]
-					else:
-						dic[key] = list(chunk_dic[key])
-				fl.close()
-				os.remove("#inter-%s-%s" % (filename, i))
+	Load the sample a finished map task left with its output.
+	"""
+	def load_sample(self, phase, t):
+		if phase != 'map':
+			return None
+		with open(os.path.join(self.task_path(phase, t), '_sample'), 'rb') as fl:
+			return pickle.load(fl)
 
-		to_reduce_chunks = self.split_list(list(dic.items()), self.num_processes)
-		# the number of chunks is equal to the number of processes.
-		j = 0
-		for ch in to_reduce_chunks:
-			fl = open("#inter-shuffled-%s" % j, "wb+")
-			pickle.dump(ch, fl)
-			fl.close()
-			j+=1
+	"""
+	Plan the reduce side from the samples of the map tasks. The partitions
+	are assigned to the num_processes reducers largest first, each one to
+	the least loaded reducer so far, so the reducers get about the same
+	number of bytes. If the job has a combiner, a partition bigger than
+	the fair share of one reducer (typically because of a hot key) and
+	than min_split_size is split further: its runs are pre-combined by
+	several combine tasks, each one over a group of the map tasks.
+	Returns the combine tasks and the reduce tasks.
+	"""
+	def plan_reduce_tasks(self, samples):
+		sizes = sum((sample['sizes'] for sample in samples), Counter())
+		hot_keys = sum((sample['hot_keys'] for sample in samples), Counter())
+		if hot_keys:
+			logging.info('The hottest keys are ' + str(hot_keys.most_common(5)) + '.')
+
+		self.combined = {}
+		combine_tasks = []
+		fair_share = sum(sizes.values()) / self.num_processes
+		# a small partition isn't worth a combine task, however skewed the job.
+		hot_size = max(fair_share, self.min_split_size)
+		num_sources = len(self.run_sources)
+		if self.combiner is not None and num_sources > 1:
+			for r, size in sorted(sizes.items()):
+				if size > hot_size:
+					groups = min(num_sources, int(-(-size // hot_size)))
+					for g in range(groups):
+						sources = self.run_sources[g::groups]
+						c = MapReduceInterface.digest(self.job_id, 'combine', r, sources)
+						combine_tasks.append((c, r, sources))
+						self.combined.setdefault(r, []).append(c)
+					logging.info('Partition #' + str(r) + ' of ' + str(size) + \
+						' bytes is split into ' + str(groups) + ' combine tasks.')
+
+		loads = [(0, i) for i in range(self.num_processes)]
+		assigned = [[] for i in range(self.num_processes)]
+		for r in sorted(range(self.num_partitions), key=lambda r: -sizes[r]):
+			load, i = heapq.heappop(loads)
+			assigned[i].append(r)
+			heapq.heappush(loads, (load + sizes[r], i))
+
+		reduce_tasks = []
+		for i in range(self.num_processes):
+			partitions = sorted(assigned[i])
+			inputs = [self.combined.get(r) for r in partitions]
+			output = (self.output_format, self.output_parts, self.sort_output, MapReduceInterface.code_digest(self.output_sort_key))
+			reduce_tasks.append((MapReduceInterface.digest(self.job_id, 'reduce', partitions, inputs, self.run_sources, \
+				MapReduceInterface.code_digest(self.reducer), output), partitions))
+		return combine_tasks, reduce_tasks
+
+	"""
+	Return the metrics of the finished job as a dict:
+
+	wall_time: the wall time of the whole job.
+	phases: for every phase (split, map, combine, reduce and merge) its
+	wall time and, for the phases run as tasks, the number of tasks, the
+	sum of their counters (task_time and cpu_time, records and bytes read
+	and written, serialization and compression time) and the highest peak
+	memory of a worker.
+	tasks: for every phase the metrics of every task that won, see run_task.
+	counters: the user defined counters summed over all tasks.
+	"""
+	def job_metrics(self, wall_time):
+		phases = {}
+		for phase, seconds in self.phase_times.items():
+			phases[phase] = {}
+			if phase in self.task_metrics:
+				tasks = self.task_metrics[phase]
+				phases[phase].update(self.stats[phase])
+				phases[phase]['task_time'] = phases[phase].pop('wall_time')
+				phases[phase]['tasks'] = len(tasks)
+				peaks = [task['peak_memory'] for task in tasks if task['peak_memory'] is not None]
+				phases[phase]['peak_memory'] = max(peaks) if peaks else None
+			phases[phase]['wall_time'] = seconds
+		return {
+			'job_id': self.job_id,
+			'num_processes': self.num_processes,
+			'wall_time': wall_time,
+			'phases': phases,
+			'tasks': self.task_metrics,
+			'counters': dict(self.counters),
+		}
 
 	"""
-	Creating one map reduce instance for each input file. This part is pretty cool.
+	Aggregate the profiles of all profiled tasks of the job into a report
+	of the profile_top functions by cumulative time and the profile_top
+	lines that allocated the most memory still in use at the end of the
+	tasks. The report is written to report.txt in profile_dir.
 	"""
-	def call_map_reduce(self, input_file):
-		MapReduce.__init__(self,  self.mapper, self.reducer, input_file, self.num_processes)
+	def profile_report(self):
+		paths = [path for tasks in self.task_metrics.values() for task in tasks for path in task.get('profile', ())]
+		if not paths:
+			return
+		report_path = os.path.join(self.profile_dir, 'report.txt')
+		with open(report_path, 'w') as fl:
+			profiles = [path for path in paths if path.endswith('.prof')]
+			if profiles:
+				fl.write('cProfile of %d tasks, top %d functions by cumulative time:\n\n' % (len(profiles), self.profile_top))
+				stats = pstats.Stats(*profiles, stream=fl)
+				stats.sort_stats('cumulative').print_stats(self.profile_top)
+
+			snapshots = [path for path in paths if path.endswith('.tracemalloc')]
+			if snapshots:
+				fl.write('tracemalloc of %d tasks, top %d lines by allocated size:\n\n' % (len(snapshots), self.profile_top))
+				sizes = Counter()
+				counts = Counter()
+				for path in snapshots:
+					for stat in tracemalloc.Snapshot.load(path).statistics('lineno'):
+						sizes[stat.traceback] += stat.size
+						counts[stat.traceback] += stat.count
+				for traceback, size in sizes.most_common(self.profile_top):
+					fl.write('%10.1f KiB %8d blocks  %s\n' % (size / 1024, counts[traceback], traceback))
+		logging.info('Wrote the profile report of ' + str(len(paths)) + ' profiles to ' + report_path + '.')
 
+	"""
+	Log the wall time of every phase and the I/O counters collected from
+	the tasks of every stage.
+	"""
+	def log_stats(self):
+		logging.info('Phase times: ' + ', '.join(phase + ' %.3fs' % seconds for phase, seconds in self.phase_times.items()) + '.')
+		for stage in self.stats:
+			stats = self.stats[stage]
+			logging.info('The ' + stage + ' stage wrote ' + str(int(stats['bytes_written'])) + \
+				' bytes (' + str(int(stats['raw_bytes_written'])) + ' uncompressed) in ' + \
+				'%.3f' % stats['serialize_time'] + 's serializing and ' + \
+				'%.3f' % stats['compress_time'] + 's compressing, and read ' + \
+				str(int(stats['bytes_read'])) + ' bytes in ' + '%.3f' % stats['deserialize_time'] + \
+				's deserializing and ' + '%.3f' % stats['decompress_time'] + 's decompressing.')
 
 
 	"""
-	Merge all reduce outputs into one final file.
-	TODO:
-	1. Can we do a better merge of reduce results? 
+	The shuffle method of the framework. Redistributes the data based on the
+	output keys (produced by the "map()" function), such that all data 
+	belonging to one key is located on the same reducer worker.
+
+	The partitioner already routed every key to a single partition, so the
+	shuffle runs inside the reducer: it does a streaming k-way merge over the
+	sorted runs of that partition and yields one (key, values) group per key
+	where values is an iterator. Only one record per run is held in memory,
+	so the values of a group must be consumed before moving to the next one.
 	"""
-	def merge_reduce_results(self):
+	def shuffle(self, run_files):
+		runs = [MapReduce.read_run(path, self.task_stats) for path in run_files]
+		merged = heapq.merge(*runs, key=itemgetter(0))
+		for key, group in itertools.groupby(merged, key=itemgetter(0)):
+			yield (key, itertools.chain.from_iterable(map(itemgetter(1), group)))
 
-		logging.info('Merging all reduce results into a final file.') 
+	"""
+	Return the partition (reducer) index of the given key. Uses a hash
+	that is stable across processes, unlike the built-in hash() of strings.
+	May be overridden by the user to control which keys go together.
+	"""
+	def partitioner(self, key, num_partitions):
+		return zlib.crc32(repr(key).encode('utf-8')) % num_partitions
 
-		final_output = open("map_reduce_output.txt", "w+")
-		for i in range(0, self.num_processes):
-			fl = open("#reduce-%s" % i, "rb")
-			temp_data = pickle.load(fl)
-			final_output.write(str(temp_data)+"\n")
-			fl.close()
-			os.remove("#reduce-%s" % i)
+	"""
+	Put the output parts of the reducers together into the output of the
+	job. Parts are moved into the output directory with a manifest, or
+	concatenated into one file as they are, or, if they are sorted (or
+	record files), merged with a streaming k-way merge. The output is
+	replaced atomically.
+	"""
+	def merge_reduce_results(self):
 
-		logging.info('Merging is done. Generating the output map_reduce_output.txt file.') 
+		logging.info('Merging all reduce results into ' + self.output + '.') 
+
+		tmp = self.output + '.tmp-' + self.job_id
+		if self.output_parts:
+			os.mkdir(tmp)
+			parts = []
+			for n, i in enumerate(self.reduce_task_ids):
+				part = 'part-%05d.%s' % (n, MapReduceInterface.output_extensions[self.output_format])
+				shutil.move(self.task_path('reduce', i), os.path.join(tmp, part))
+				parts.append({'name': part, 'bytes': os.path.getsize(os.path.join(tmp, part))})
+			with open(os.path.join(tmp, 'manifest.json'), 'w') as fl:
+				json.dump({'format': self.output_format, 'sorted': self.sort_output, 'parts': parts}, fl, indent=1)
+		elif self.output_format == 'records':
+			runs = [MapReduce.read_run(self.task_path('reduce', i)) for i in self.reduce_task_ids]
+			records = heapq.merge(*runs, key=self.output_sort_key) if self.sort_output else itertools.chain(*runs)
+			self.task_stats = Counter()
+			writer = self.record_writer(tmp, 'reduce')
+			for record in records:
+				writer.write(record)
+			writer.close()
+		else:
+			with open(tmp, 'w', newline='') as final_output:
+				if self.sort_output:
+					write = self.output_record_writer(final_output)
+					runs = [MapReduce.read_run(self.task_path('reduce', i)) for i in self.reduce_task_ids]
+					for record in heapq.merge(*runs, key=self.output_sort_key):
+						write(record)
+				else:
+					for i in self.reduce_task_ids:
+						with open(self.task_path('reduce', i), newline='') as part:
+							shutil.copyfileobj(part, final_output)
+		if os.path.isdir(self.output):
+			shutil.rmtree(self.output)
+		elif self.output_parts and os.path.exists(self.output):
+			os.remove(self.output)
+		os.replace(tmp, self.output)
+
+		logging.info('Merging is done. Generated the output ' + self.output + '.') 
 
 
 """
-Class NoDaemonProcess.
+Class JobRunner.
+
+Keeps one long-lived pool of worker processes and runs MapReduce jobs
+on it back-to-back, so the workers are spawned once for all the jobs:
 
-The multiprocessing Pool class creates daemonic processes that are not allowed 
-to have children which means that one process can't create sub-processes
-(worker processes) which we need to do in our MapReduce. 
-The solution is to create a class that inherits from multiprocessing.Processes 
-and override the _get_daemon method to return False.
+	with JobRunner() as runner:
+		runner.run(WordCount(txt_files))
+		runner.run(Twitter(json_files, 'lang', 'en'))
 
-Otherwide the exception below is thrown:
-AssertionError: daemonic processes are not allowed to have children
+processes: the number of workers, by default the number of CPUs.
 """
-class NoDaemonProcess(multiprocessing.Process):
+class JobRunner:
 
-	# make 'daemon' attribute always return False
-	def _get_daemon(self):
-		return False
+	def __init__(self, processes=None):
+		configure_logging()
+		self.processes = processes or os.cpu_count() or 1
+		self.pool = Pool(processes=self.processes)
+		logging.info('Created a job runner with ' + str(self.processes) + ' worker processes.')
 
-	def _set_daemon(self, value):
-		pass
+	"""
+	Run the job on the pool of the runner.
+	"""
+	def run(self, job):
+		return job.run_program(pool=self.pool)
 
-	daemon = property(_get_daemon, _set_daemon)
+	"""
+	Stop the workers once the queued tasks are done.
+	"""
+	def close(self):
+		self.pool.close()
+		self.pool.join()
 
+	def __enter__(self):
+		return self
 
-"""
-Class MyMRPool.
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
 
-MyMRPool is a class that can create a non-daemonic pool of processes. 
-We sub-class multiprocessing.pool.Pool instead of multiprocessing.Pool
-because the latter is only a wrapper function, not a proper class.
+
+"""
+Class JobChain.
+
+Runs MapReduce jobs one after the other where the output of a job is the
+input of the next one. Every job but the last writes its reduce output
+parts as record files, in the intermediate binary format, and the next
+job maps them frame by frame, so no job has to format or parse text:
+
+	chain = JobChain(WordCount(txt_files), lambda parts: TopWords(parts))
+	metrics = chain.run()
+
+first_job: the first job of the chain.
+stages: functions that take the list of output parts of the previous job
+and return the next job.
+materialize: keep the outputs of the intermediate jobs in work_dir
+after the chain finished. By default the output of a job is removed as
+soon as the next job is done with it.
+work_dir: the directory for the outputs of the intermediate jobs.
 """
-class MyMRPool(multiprocessing.pool.Pool):
-	Process = NoDaemonProcess
+class JobChain:
+
+	def __init__(self, first_job, *stages, materialize=False, work_dir=None):
+		self.first_job = first_job
+		self.stages = stages
+		self.materialize = materialize
+		self.work_dir = work_dir or "#chain-" + uuid.uuid4().hex[:12]
+
+	"""
+	Run the jobs of the chain on one pool of workers, the given one or
+	the pool of a JobRunner created for the chain.
+	Returns the list of the metrics of the jobs.
+	"""
+	def run(self, pool=None):
+		if pool is None:
+			with JobRunner(self.first_job.num_processes) as runner:
+				return self.run(runner.pool)
+
+		os.makedirs(self.work_dir, exist_ok=True)
+		metrics = []
+		job = self.first_job
+		previous_output = None
+		try:
+			for n, stage in enumerate(self.stages):
+				job.output_format = 'records'
+				job.output_parts = True
+				job.output = os.path.join(self.work_dir, 'stage-%d' % n)
+				metrics.append(job.run_program(pool=pool))
+				if previous_output is not None and not self.materialize:
+					shutil.rmtree(previous_output)
+				previous_output = job.output
+				job = stage(JobChain.output_parts(job.output))
+			metrics.append(job.run_program(pool=pool))
+		finally:
+			if not self.materialize:
+				shutil.rmtree(self.work_dir, ignore_errors=True)
+		return metrics
+
+	"""
+	Return the paths of the output parts a job wrote to the directory
+	output, as listed in its manifest.
+	"""
+	@classmethod
+	def output_parts(cls, output):
+		with open(os.path.join(output, 'manifest.json')) as fl:
+			return [os.path.join(output, part['name']) for part in json.load(fl)['parts']]
 
 
 """
@@ -26,25 +26,42 @@ Version: 1.0
 Date: 11/02/2014
 
 Numeric operations program that inherits from the MapReduceInterface framework.
-Takes a .csv files and a column number and returns the min, max, avg
-values of the given column.
+Takes a .csv files and one or more column numbers and returns the count,
+sum, min, max, mean and standard deviation of the values of every column.
+Integer and float columns are supported. The columns are parsed in blocks
+of rows, with NumPy if it is installed and with the csv module otherwise.
 """
 
 from map_reduce import *
 
+import io
 import csv
+import math
+
+# NumPy is optional, the job falls back to pure Python without it.
+try:
+	import numpy
+except ImportError:
+	numpy = None
 
 """
 Numeric class.
 """
 class Numeric(MapReduceInterface):
 
+	"""
+	The number of rows parsed at once by the mapper.
+	"""
+	block_rows = 65536
+
 	"""
 	files: the files that the Numeric program should run on.
 	col_number:  the column number or the field number, start from 1.
+	A list of column numbers computes the stats of every column.
 	"""
 	def __init__(self, files, col_number):
 		self.col_number = col_number
+		self.columns = list(col_number) if isinstance(col_number, (list, tuple)) else [col_number]
 		self.files = files
 		mapper = self.mapper
 		reducer = self.reducer
@@ -52,43 +69,167 @@ class Numeric(MapReduceInterface):
 		
 	"""
 	The map function for numeric program.
-	Takes a chunk csv file and 
-	returns the (min, max, avg) values of the file.
+	Takes a chunk csv file, parses the given columns block by block and
+	yields one (column, (count, sum, min, max, m2)) partial aggregate per
+	column (see partial). The partials of different chunks are merged
+	exactly by the combiner and the reducer.
 	"""
 	def mapper(self, csv_chunk):
-		lst = self.load(csv_chunk)
-		elems = [int(i) for i in lst]
-		avg = sum(elems) / len(elems)
-		return [(1, (min(elems), max(elems), avg))]
+		partials = {column: None for column in self.columns}
+		for lines in self.blocks(csv_chunk):
+			for column, values in self.parse_block(lines).items():
+				partials[column] = Numeric.merge_partials(partials[column], Numeric.partial(values))
+		for column, partial in partials.items():
+			if partial is not None:
+				yield (column, partial)
+
+	"""
+	Split the lines of a csv chunk into blocks of about block_rows lines.
+	A block only ends where the number of quotes so far is even, so a
+	quoted field spanning several lines never straddles two blocks.
+	"""
+	def blocks(self, csv_chunk):
+		lines = []
+		quotes = 0
+		for line in csv_chunk:
+			lines.append(line)
+			quotes += line.count('"')
+			if len(lines) >= self.block_rows and quotes % 2 == 0:
+				yield lines
+				lines = []
+				quotes = 0
+		if lines:
+			yield lines
+
+	"""
+	Parse the given columns of a block of csv lines. Returns a dict of
+	column -> values, a NumPy array or a list. Blocks with quoted fields
+	or values NumPy can't parse go through the csv module. Empty values
+	are skipped.
+	"""
+	def parse_block(self, lines):
+		text = ''.join(lines)
+		if numpy is not None and '"' not in text:
+			try:
+				return self.parse_block_numpy(text)
+			except ValueError:
+				pass
+
+		columns = {column: [] for column in self.columns}
+		for row in csv.reader(lines):
+			for column, values in columns.items():
+				if len(row) >= column and row[column-1].strip():
+					values.append(Numeric.number(row[column-1]))
+		return columns
+
+	"""
+	Parse the given columns of a block of csv text with NumPy in one pass.
+	Columns holding integers only become 64 bit integer arrays, the others
+	stay floats. Integers too big for a float to hold exactly are left to
+	the csv module.
+	"""
+	def parse_block_numpy(self, text):
+		usecols = [column - 1 for column in self.columns]
+		table = numpy.loadtxt(io.StringIO(text), delimiter=',', comments=None, usecols=usecols,
+			dtype=numpy.float64, ndmin=2)
+		columns = {}
+		for n, column in enumerate(self.columns):
+			values = table[:, n]
+			if numpy.array_equal(values, numpy.trunc(values)):
+				if len(values) and numpy.abs(values).max() >= 2 ** 53:
+					raise ValueError("integers too big for a float")
+				values = values.astype(numpy.int64)
+			columns[column] = values
+		return columns
+
+	"""
+	Convert a csv value into an int, or a float if it isn't an integer.
+	"""
+	@classmethod
+	def number(cls, value):
+		try:
+			return int(value)
+		except ValueError:
+			return float(value)
+
+	"""
+	Return the (count, sum, min, max, m2) partial aggregate of a NumPy
+	array or a list of numbers, or None if there are no values. For
+	integers the sum is an int and m2 is the exact sum of squares; NumPy
+	is only trusted with them when they can't overflow 64 bits. Otherwise
+	the sum is a float and m2 is the sum of the squared deviations from
+	the mean, computed in two passes so it doesn't cancel.
+	"""
+	@classmethod
+	def partial(cls, values):
+		if len(values) == 0:
+			return None
+		if numpy is not None and isinstance(values, numpy.ndarray):
+			minimum, maximum = values.min().item(), values.max().item()
+			if values.dtype.kind == 'i' and max(abs(minimum), abs(maximum)) ** 2 * len(values) >= 2 ** 63:
+				values = values.tolist()
+			elif values.dtype.kind == 'i':
+				return (len(values), values.sum().item(), minimum, maximum, numpy.dot(values, values).item())
+			else:
+				deviations = values - values.mean()
+				return (len(values), values.sum().item(), minimum, maximum, numpy.dot(deviations, deviations).item())
+		total = sum(values)
+		if isinstance(total, int):
+			return (len(values), total, min(values), max(values), sum(value * value for value in values))
+		mean = total / len(values)
+		return (len(values), total, min(values), max(values), sum((value - mean) ** 2 for value in values))
+
+	"""
+	Return m2 of a partial aggregate as the sum of the squared deviations
+	from the mean, converting the sum of squares of an integer partial.
+	"""
+	@classmethod
+	def deviations(cls, partial):
+		count, total, minimum, maximum, m2 = partial
+		if isinstance(total, int):
+			return (m2 * count - total * total) / count
+		return m2
+
+	"""
+	Merge two partial aggregates (either may be None). Integer partials
+	add up exactly; otherwise the squared deviations are merged with the
+	formula of Chan et al.
+	"""
+	@classmethod
+	def merge_partials(cls, a, b):
+		if a is None:
+			return b
+		if b is None:
+			return a
+		count, total = a[0] + b[0], a[1] + b[1]
+		if isinstance(total, int):
+			m2 = a[4] + b[4]
+		else:
+			delta = b[1] / b[0] - a[1] / a[0]
+			m2 = Numeric.deviations(a) + Numeric.deviations(b) + delta * delta * a[0] * b[0] / count
+		return (count, total, min(a[2], b[2]), max(a[3], b[3]), m2)
+
+	"""
+	The combiner for the numeric program. Merges the partial aggregates
+	of every column into one.
+	"""
+	def combiner(self, key_values_list):
+		for column, partials in key_values_list:
+			partial = None
+			for other in partials:
+				partial = Numeric.merge_partials(partial, other)
+			yield (column, partial)
 
 	"""
-	The reduce function for the numeric program.
+	The reduce function for the numeric program. Merges the partial
+	aggregates of every column and yields
+	(column, (count, sum, min, max, mean, standard deviation)).
 	"""
 	def reducer(self, key_values_list):
-		mins = 0
-		maxs  = 0
-		avgs = 0
-		ln = 1
-		for entry in key_values_list:
-			key = entry[0]
-			# list of tuples
-			tple_list = entry[1]
-			ln = len(tple_list)
-			for tple in tple_list:
-				mins = tple[0]
-				maxs = tple[1]
-				avgs = tple[2]
-
-		return (mins, maxs, avgs // ln)
-
-	"""
-	Load a .csv file and append all the values
-	of the user given column. In short, loads the whole
-	column into a new list. The column is the column given by user.
-	"""
-	def load(self, csv_file):
-		reader = csv.reader(csv_file)
-		all_rows = []
-		for row in reader:
-			all_rows.append(row[self.col_number-1])
-		return all_rows
+		for column, (count, total, minimum, maximum, m2) in self.combiner(key_values_list):
+			if isinstance(total, int):
+				# exact for integer columns, the numerator is computed on Python ints.
+				variance = max((m2 * count - total * total) / (count * count), 0)
+			else:
+				variance = max(m2 / count, 0)
+			yield (column, (count, total, minimum, maximum, total / count, math.sqrt(variance)))
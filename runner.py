@@ -86,7 +86,9 @@ if __name__ == '__main__':
 		mr_job = Twitter(input_files, attr, attr_value)
 	elif ext == "csv":
 		input_files = sys.argv[1:-1]
-		column_number = int(sys.argv[-1])
+		# one column number or a comma separated list of them.
+		column_numbers = [int(column) for column in sys.argv[-1].split(',')]
+		column_number = column_numbers[0] if len(column_numbers) == 1 else column_numbers
 		mr_job = Numeric(input_files, column_number)
 	else:
 		pass
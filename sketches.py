@@ -0,0 +1,332 @@
+"""
+The MIT License
+
+Copyright (c) Tigran Hakobyan. http://tiggreen.me
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+Mergeable sketches for approximate aggregates over big inputs.
+
+A mapper builds a sketch over its whole chunk and yields it as a single
+(key, sketch) pair instead of one pair per item. Sketches of the same key
+are merged by merge_sketches, which is meant to be the combiner of the
+job, so they are merged in a tree: within every map task, by the merge
+and combine tasks of the framework and finally by the reducer. A sketch
+takes a few kilobytes whatever the number of items it saw.
+
+HyperLogLog   --> the number of distinct items
+CountMinSketch --> the frequency of items and the top-k most frequent ones
+TDigest       --> quantiles of numbers
+
+Every sketch reports the bound of its error. The hashes are stable across
+processes, unlike the built-in hash() of strings, so sketches built by
+different workers can be merged.
+"""
+
+import math
+import heapq
+import hashlib
+from array import array
+
+"""
+Return a stable 64 bit hash of the repr of an item.
+"""
+def hash64(item):
+	return int.from_bytes(hashlib.blake2b(repr(item).encode('utf-8'), digest_size=8).digest(), 'big')
+
+"""
+The combiner (and the core of the reducer) of a sketch job: merges all
+the sketches of every key into one.
+"""
+def merge_sketches(key_values_list):
+	for key, sketches in key_values_list:
+		sketches = iter(sketches)
+		merged = next(sketches)
+		for sketch in sketches:
+			merged.merge(sketch)
+		yield (key, merged)
+
+
+"""
+Class HyperLogLog.
+
+Estimates the number of distinct items with 2 ** precision one byte
+registers. The relative standard error of the estimate is
+1.04 / sqrt(2 ** precision), 0.8% with the default precision of 14
+(16 KB of registers).
+"""
+class HyperLogLog:
+
+	def __init__(self, precision=14):
+		if not 4 <= precision <= 18:
+			raise ValueError("The precision must be between 4 and 18.")
+		self.precision = precision
+		self.registers = bytearray(1 << precision)
+
+	"""
+	Add an item to the sketch.
+	"""
+	def add(self, item):
+		x = hash64(item)
+		bits = 64 - self.precision
+		index = x >> bits
+		rank = bits - (x & ((1 << bits) - 1)).bit_length() + 1
+		if rank > self.registers[index]:
+			self.registers[index] = rank
+
+	"""
+	Merge another HyperLogLog of the same precision into this one.
+	"""
+	def merge(self, other):
+		if other.precision != self.precision:
+			raise ValueError("Can't merge HyperLogLogs of different precisions.")
+		self.registers = bytearray(map(max, self.registers, other.registers))
+		return self
+
+	"""
+	Return the estimated number of distinct items added to the sketch.
+	Small cardinalities are estimated by linear counting.
+	"""
+	def count(self):
+		m = len(self.registers)
+		alpha = 0.7213 / (1 + 1.079 / m)
+		estimate = alpha * m * m / sum(2.0 ** -register for register in self.registers)
+		zeros = self.registers.count(0)
+		if estimate <= 2.5 * m and zeros:
+			estimate = m * math.log(m / zeros)
+		return estimate
+
+	"""
+	Return the relative standard error of the estimate.
+	"""
+	def error(self):
+		return 1.04 / math.sqrt(len(self.registers))
+
+	def __repr__(self):
+		return 'HyperLogLog(count=%.0f, error=%.2f%%)' % (self.count(), 100 * self.error())
+
+
+"""
+Class CountMinSketch.
+
+Estimates the frequency of items in a depth x width table of counters.
+An estimate is never below the true count, and with probability
+1 - exp(-depth) it exceeds it by at most e / width times the total count
+of all items. With top_k the sketch also tracks the top_k items with the
+highest estimated counts (the heavy hitters).
+"""
+class CountMinSketch:
+
+	def __init__(self, width=2048, depth=5, top_k=0):
+		self.width = width
+		self.depth = depth
+		self.top_k = top_k
+		self.total = 0
+		self.table = [array('q', bytes(8 * width)) for row in range(depth)]
+		self.heavy_hitters = {}
+
+	"""
+	Return the column of the item in every row of the table. The rows
+	use the hashes h1 + row * h2 of two halves of one 64 bit hash.
+	"""
+	def columns(self, item):
+		x = hash64(item)
+		h1, h2 = x >> 32, (x & 0xffffffff) | 1
+		return [(h1 + row * h2) % self.width for row in range(self.depth)]
+
+	"""
+	Add count occurrences of an item to the sketch.
+	"""
+	def add(self, item, count=1):
+		self.total += count
+		estimate = None
+		for row, column in zip(self.table, self.columns(item)):
+			row[column] += count
+			if estimate is None or row[column] < estimate:
+				estimate = row[column]
+		if self.top_k:
+			self.track(item, estimate)
+
+	"""
+	Keep the item among the heavy hitters if its estimate is among the
+	top_k ones. The candidates are trimmed lazily, once there are twice
+	as many as needed.
+	"""
+	def track(self, item, estimate):
+		self.heavy_hitters[item] = estimate
+		if len(self.heavy_hitters) > 2 * self.top_k:
+			self.heavy_hitters = dict(heapq.nlargest(self.top_k, self.heavy_hitters.items(), key=lambda pair: pair[1]))
+
+	"""
+	Return the estimated count of an item.
+	"""
+	def estimate(self, item):
+		return min(row[column] for row, column in zip(self.table, self.columns(item)))
+
+	"""
+	Merge another CountMinSketch of the same shape into this one. The
+	heavy hitters of both are re-estimated from the merged table.
+	"""
+	def merge(self, other):
+		if (other.width, other.depth) != (self.width, self.depth):
+			raise ValueError("Can't merge CountMinSketches of different shapes.")
+		for row, other_row in zip(self.table, other.table):
+			for column, count in enumerate(other_row):
+				if count:
+					row[column] += count
+		self.total += other.total
+		self.top_k = max(self.top_k, other.top_k)
+		candidates = set(self.heavy_hitters) | set(other.heavy_hitters)
+		self.heavy_hitters = {}
+		for item in candidates:
+			self.track(item, self.estimate(item))
+		return self
+
+	"""
+	Return the top_k (item, estimated count) pairs, most frequent first.
+	"""
+	def top(self):
+		return heapq.nlargest(self.top_k, self.heavy_hitters.items(), key=lambda pair: pair[1])
+
+	"""
+	Return the bound of the overestimation of a count, which holds with
+	probability confidence().
+	"""
+	def error(self):
+		return math.e / self.width * self.total
+
+	"""
+	Return the probability that an estimate is within error() of the true count.
+	"""
+	def confidence(self):
+		return 1 - math.exp(-self.depth)
+
+	def __repr__(self):
+		return 'CountMinSketch(total=%d, error=%.1f, top=%r)' % (self.total, self.error(), self.top())
+
+
+"""
+Class TDigest.
+
+Estimates quantiles of numbers with a merging t-digest of at most about
+compression / 2 centroids. The size of the centroids follows the arcsine
+scale function, so they are small near the tails: the rank error of the q
+quantile is about pi * sqrt(q * (1 - q)) / compression, which makes the
+extreme quantiles very accurate.
+"""
+class TDigest:
+
+	def __init__(self, compression=100):
+		self.compression = compression
+		self.centroids = []
+		self.buffer = []
+		self.count = 0
+		self.min = math.inf
+		self.max = -math.inf
+
+	"""
+	Add a number with the given weight to the digest.
+	"""
+	def add(self, value, weight=1):
+		self.buffer.append((value, weight))
+		self.count += weight
+		if value < self.min:
+			self.min = value
+		if value > self.max:
+			self.max = value
+		if len(self.buffer) >= 10 * self.compression:
+			self.compress()
+
+	"""
+	Merge the buffered numbers into the centroids. Neighbouring centroids
+	are merged as long as the merged centroid spans at most one unit of
+	the scale function k(q) = compression / (2 * pi) * asin(2 * q - 1).
+	"""
+	def compress(self):
+		if not self.buffer:
+			return
+		points = sorted(self.centroids + self.buffer)
+		self.buffer = []
+		centroids = []
+		mean, weight = points[0]
+		cumulative = 0
+		k_left = self.scale(0)
+		for value, value_weight in points[1:]:
+			if self.scale((cumulative + weight + value_weight) / self.count) - k_left <= 1:
+				mean += (value - mean) * value_weight / (weight + value_weight)
+				weight += value_weight
+			else:
+				centroids.append((mean, weight))
+				cumulative += weight
+				k_left = self.scale(cumulative / self.count)
+				mean, weight = value, value_weight
+		centroids.append((mean, weight))
+		self.centroids = centroids
+
+	"""
+	The scale function of the digest.
+	"""
+	def scale(self, q):
+		return self.compression / (2 * math.pi) * math.asin(min(1, max(-1, 2 * q - 1)))
+
+	"""
+	Merge another TDigest into this one.
+	"""
+	def merge(self, other):
+		self.buffer.extend(other.centroids)
+		self.buffer.extend(other.buffer)
+		self.count += other.count
+		self.min = min(self.min, other.min)
+		self.max = max(self.max, other.max)
+		self.compress()
+		return self
+
+	"""
+	Return the estimated q quantile (0 <= q <= 1), interpolating between
+	the centroids.
+	"""
+	def quantile(self, q):
+		self.compress()
+		if not self.centroids:
+			return None
+		if len(self.centroids) == 1:
+			return self.centroids[0][0]
+		rank = q * self.count
+		# the centre of every centroid sits at the middle of its weight.
+		cumulative = 0
+		previous_mean, previous_rank = self.min, 0
+		for mean, weight in self.centroids:
+			centre = cumulative + weight / 2
+			if rank < centre:
+				fraction = (rank - previous_rank) / (centre - previous_rank) if centre > previous_rank else 0
+				return previous_mean + fraction * (mean - previous_mean)
+			previous_mean, previous_rank = mean, centre
+			cumulative += weight
+		fraction = (rank - previous_rank) / (self.count - previous_rank) if self.count > previous_rank else 0
+		return previous_mean + fraction * (self.max - previous_mean)
+
+	"""
+	Return the approximate bound of the rank error of the q quantile, as
+	a fraction of the count.
+	"""
+	def error(self, q):
+		return max(math.pi * math.sqrt(q * (1 - q)) / self.compression, 1 / max(self.count, 1))
+
+	def __repr__(self):
+		return 'TDigest(count=%d, median=%r)' % (self.count, self.quantile(0.5))
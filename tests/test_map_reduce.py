@@ -0,0 +1,440 @@
+"""
+Tests of the MapReduce framework. Run from the top directory with
+
+	python -m unittest discover tests
+"""
+
+import os
+import sys
+import pickle
+import shutil
+import random
+import tempfile
+import tracemalloc
+import subprocess
+import unittest
+import multiprocessing
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from map_reduce import MapReduce, MapReduceInterface
+
+
+"""
+A word count whose reducer returns a list instead of yielding.
+"""
+class ListWordCount(MapReduceInterface):
+
+	def __init__(self, files):
+		MapReduceInterface.__init__(self, self.mapper, self.reducer, files)
+
+	def mapper(self, file_chunk):
+		for line in file_chunk:
+			for w in line.split():
+				yield (w, 1)
+
+	def reducer(self, key_values_list):
+		return [(key, sum(values)) for key, values in key_values_list]
+
+
+"""
+A word count of the words of at least min_len letters. Its mapper notes
+every chunk it maps in the file 'mapped', and its reducer fails as long
+as the file 'fail' exists.
+"""
+class MinLengthCount(MapReduceInterface):
+
+	min_len = 1
+
+	def __init__(self, files):
+		MapReduceInterface.__init__(self, self.mapper, self.reducer, files)
+
+	def mapper(self, file_chunk):
+		with open('mapped', 'a') as fl:
+			fl.write('chunk\n')
+		for line in file_chunk:
+			for w in line.split():
+				if len(w) >= self.min_len:
+					yield (w, 1)
+
+	def reducer(self, key_values_list):
+		if os.path.exists('fail'):
+			raise RuntimeError('the reducer failed')
+		for key, values in key_values_list:
+			yield (key, sum(values))
+
+
+class SortOutputTest(unittest.TestCase):
+
+	def setUp(self):
+		self.cwd = os.getcwd()
+		self.dir = tempfile.mkdtemp()
+		os.chdir(self.dir)
+
+	def tearDown(self):
+		os.chdir(self.cwd)
+		shutil.rmtree(self.dir)
+
+	"""
+	A list returned by the reducer is sorted in several runs when it
+	holds more than spill_threshold results.
+	"""
+	def test_list_reducer_with_sort_output(self):
+		words = ['w%03d' % (n % 250) for n in range(1000)]
+		with open('words.txt', 'w') as fl:
+			fl.write(' '.join(reversed(words)) + '\n')
+		job = ListWordCount(['words.txt'])
+		job.num_processes = 2
+		job.sort_output = True
+		job.spill_threshold = 100
+		job.output_format = 'tsv'
+		job.run_program()
+		with open('map_reduce_output.txt') as fl:
+			lines = fl.read().splitlines()
+		self.assertEqual(lines, ['w%03d\t4' % n for n in range(250)])
+
+
+class ResumeTest(unittest.TestCase):
+
+	def setUp(self):
+		self.cwd = os.getcwd()
+		self.dir = tempfile.mkdtemp()
+		os.chdir(self.dir)
+		with open('words.txt', 'w') as fl:
+			fl.write('a bb ccc dddd\n' * 100)
+		open('fail', 'w').close()
+		with self.assertRaises(Exception):
+			self.run_job()
+		os.remove('fail')
+
+	def tearDown(self):
+		MinLengthCount.min_len = 1
+		os.chdir(self.cwd)
+		shutil.rmtree(self.dir)
+
+	def run_job(self, **options):
+		job = MinLengthCount(['words.txt'])
+		job.num_processes = 2
+		for name, value in options.items():
+			setattr(job, name, value)
+		job.run_program()
+		with open('map_reduce_output.txt') as fl:
+			return sorted(fl.read().splitlines())
+
+	def mapped(self):
+		with open('mapped') as fl:
+			return len(fl.readlines())
+
+	"""
+	Rerunning the same job reuses the map outputs of the failed run.
+	"""
+	def test_resume(self):
+		mapped = self.mapped()
+		self.assertEqual(self.run_job(), [str(('a', 100)), str(('bb', 100)), str(('ccc', 100)), str(('dddd', 100))])
+		self.assertEqual(self.mapped(), mapped)
+
+	"""
+	A class attribute changed after the failed run makes it a new job.
+	"""
+	def test_changed_class_attribute(self):
+		MinLengthCount.min_len = 3
+		self.assertEqual(self.run_job(), [str(('ccc', 100)), str(('dddd', 100))])
+
+	"""
+	So does an attribute set on the job after creating it.
+	"""
+	def test_changed_instance_attribute(self):
+		self.assertEqual(self.run_job(min_len=4), [str(('dddd', 100))])
+
+
+class CacheTest(unittest.TestCase):
+
+	def setUp(self):
+		self.cwd = os.getcwd()
+		self.dir = tempfile.mkdtemp()
+		os.chdir(self.dir)
+		with open('words.txt', 'w') as fl:
+			fl.write('a bb ccc dddd\n' * 100)
+
+	def tearDown(self):
+		MinLengthCount.min_len = 1
+		os.chdir(self.cwd)
+		shutil.rmtree(self.dir)
+
+	def run_job(self):
+		job = MinLengthCount(['words.txt'])
+		job.num_processes = 2
+		job.cache_dir = 'cache'
+		metrics = job.run_program()
+		with open('map_reduce_output.txt') as fl:
+			return sorted(fl.read().splitlines()), metrics['phases']['map'].get('cache_hits', 0)
+
+	"""
+	An unchanged job takes its map outputs from the cache, a job whose
+	class attribute changed doesn't.
+	"""
+	def test_changed_class_attribute(self):
+		output, hits = self.run_job()
+		self.assertEqual((len(output), hits), (4, 0))
+		output, hits = self.run_job()
+		self.assertEqual((len(output), hits > 0), (4, True))
+		MinLengthCount.min_len = 3
+		output, hits = self.run_job()
+		self.assertEqual((output, hits), ([str(('ccc', 100)), str(('dddd', 100))], 0))
+
+
+class CsvRowOffsetsTest(unittest.TestCase):
+
+	def setUp(self):
+		self.cwd = os.getcwd()
+		self.dir = tempfile.mkdtemp()
+		os.chdir(self.dir)
+
+	def tearDown(self):
+		os.chdir(self.cwd)
+		shutil.rmtree(self.dir)
+
+	"""
+	The offsets csv_row_offsets should return, by walking the rows of the
+	whole data one byte at a time.
+	"""
+	def expected_offsets(self, data, targets):
+		row_ends = []
+		quoted = False
+		for i, byte in enumerate(data):
+			if byte == ord('"'):
+				quoted = not quoted
+			elif byte == ord('\n') and not quoted:
+				row_ends.append(i + 1)
+		offsets = []
+		for target in targets:
+			if offsets and target < offsets[-1]:
+				continue
+			ends = [end for end in row_ends if end - 1 >= target]
+			if ends:
+				offsets.append(ends[0])
+		return offsets
+
+	"""
+	Quoted fields with newlines, escaped quotes and commas, scanned in
+	blocks smaller than the rows so rows and quotes straddle the blocks.
+	"""
+	def test_quoted_newlines(self):
+		rnd = random.Random(6)
+		fields = ['1', '"a,b"', '"multi\nline"', '"say ""hi""\n"', '""', '"\n\n"', 'plain text']
+		rows = [','.join(rnd.choice(fields) for n in range(3)) + '\n' for n in range(200)]
+		data = ('h1,h2,h3\n' + ''.join(rows)).encode('utf-8')
+		with open('data.csv', 'wb') as fl:
+			fl.write(data)
+		job = ListWordCount(['data.csv'])
+		job.file = 'data.csv'
+		for block_size in (5, 64, 1 << 16):
+			for step in (1, 37, 500):
+				targets = list(range(0, len(data), step))
+				with mock.patch.object(MapReduce, 'scan_block_size', block_size):
+					self.assertEqual(job.csv_row_offsets(targets), self.expected_offsets(data, targets))
+
+
+class LoggingTest(unittest.TestCase):
+
+	def setUp(self):
+		self.cwd = os.getcwd()
+		self.dir = tempfile.mkdtemp()
+		os.chdir(self.dir)
+
+	def tearDown(self):
+		os.chdir(self.cwd)
+		shutil.rmtree(self.dir)
+
+	"""
+	The log is written when a job runner is created before any job.
+	"""
+	def test_job_runner_first(self):
+		script = '''
+import sys
+sys.path.insert(0, %r)
+from map_reduce import JobRunner
+from word_count import WordCount
+with open('words.txt', 'w') as fl:
+	fl.write('a b a\\n')
+with JobRunner(2) as runner:
+	runner.run(WordCount(['words.txt']))
+''' % os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+		subprocess.run([sys.executable, '-c', script], check=True)
+		with open('map_reduce.log') as fl:
+			self.assertIn('Created a job runner with 2 worker processes.', fl.read())
+
+
+class DispatchTest(unittest.TestCase):
+
+	def setUp(self):
+		self.cwd = os.getcwd()
+		self.dir = tempfile.mkdtemp()
+		os.chdir(self.dir)
+		self.files = []
+		for n in range(50):
+			self.files.append('words-%02d.txt' % n)
+			with open(self.files[-1], 'w') as fl:
+				fl.write('a b c\n')
+
+	def tearDown(self):
+		os.chdir(self.cwd)
+		shutil.rmtree(self.dir)
+
+	"""
+	The job pickled with every task doesn't carry the state of the master
+	(e.g. the input files), so its size doesn't grow with the job.
+	"""
+	def test_pickled_job_size(self):
+		job = ListWordCount(self.files)
+		job.num_processes = 2
+		job.cache_dir = 'cache'
+		job.run_program()
+		pickled = pickle.dumps(job)
+		for name in ('files', 'manifest', 'task_metrics', 'cache_keys'):
+			self.assertNotIn(name, pickle.loads(pickled).__dict__)
+		self.assertNotIn(b'words-00.txt', pickled)
+		self.assertLess(len(pickled), 2000)
+
+	"""
+	Without the resource module (e.g. on Windows) jobs still run, and the
+	peak memory of their tasks is None.
+	"""
+	def test_without_resource(self):
+		script = '''
+import sys
+sys.modules['resource'] = None
+sys.path.insert(0, %r)
+from word_count import WordCount
+metrics = WordCount(['words-00.txt']).run_program()
+assert metrics['phases']['map']['peak_memory'] is None
+assert all(task['peak_memory'] is None for task in metrics['tasks']['map'])
+''' % os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+		subprocess.run([sys.executable, '-c', script], check=True)
+
+
+class ProfilingTest(unittest.TestCase):
+
+	def setUp(self):
+		self.cwd = os.getcwd()
+		self.dir = tempfile.mkdtemp()
+		os.chdir(self.dir)
+		with open('words.txt', 'w') as fl:
+			fl.write('a bb ccc dddd\n')
+
+	def tearDown(self):
+		os.chdir(self.cwd)
+		shutil.rmtree(self.dir)
+
+	"""
+	A profiled task that fails leaves no profiler running in the worker.
+	"""
+	def test_failed_task_stops_the_profilers(self):
+		job = MinLengthCount(['words.txt'])
+		job.profile = ('cprofile', 'tracemalloc')
+		job.profile_sample = 1
+		task = ('0123456789abcdef', [], None)
+		def fail(task, attempt):
+			raise RuntimeError('the task failed')
+		fail.__name__ = 'apply_map'
+		with self.assertRaises(RuntimeError):
+			job.run_task(fail, task, 0)
+		self.assertFalse(tracemalloc.is_tracing())
+		self.assertIsNone(sys.getprofile())
+
+
+class LockWorkDirsTest(unittest.TestCase):
+
+	def setUp(self):
+		self.cwd = os.getcwd()
+		self.dir = tempfile.mkdtemp()
+		os.chdir(self.dir)
+		with open('words.txt', 'w') as fl:
+			fl.write('a b c\n')
+		self.job = ListWordCount(['words.txt'])
+		self.job.job_id = 'test'
+
+	def tearDown(self):
+		os.chdir(self.cwd)
+		shutil.rmtree(self.dir)
+
+	"""
+	Leave a lock with the given content in the work directory of the job.
+	"""
+	def leave_lock(self, content):
+		os.mkdir('#job-test')
+		with open(os.path.join('#job-test', 'lock'), 'w') as fl:
+			fl.write(content)
+
+	def test_free(self):
+		self.job.lock_work_dirs()
+		self.assertEqual(self.job.job_id, 'test')
+		with open(os.path.join('#job-test', 'lock')) as fl:
+			self.assertEqual(fl.read(), self.job.lock_content)
+		self.assertEqual(int(self.job.lock_content.split()[0]), os.getpid())
+		self.assertEqual(os.listdir('#job-test'), ['lock'])
+
+	def test_held_by_a_live_process(self):
+		self.leave_lock(str(os.getppid()))
+		self.job.lock_work_dirs()
+		self.assertTrue(self.job.job_id.startswith('test-'))
+
+	"""
+	An empty lock may be one being created right now, so it is held.
+	"""
+	def test_empty_lock_is_held(self):
+		self.leave_lock('')
+		self.job.lock_work_dirs()
+		self.assertTrue(self.job.job_id.startswith('test-'))
+
+	"""
+	Return the pid of a process that exited.
+	"""
+	def dead_pid(self):
+		process = multiprocessing.Process(target=int)
+		process.start()
+		process.join()
+		return process.pid
+
+	def test_stale_lock_is_taken_over(self):
+		self.leave_lock(str(self.dead_pid()))
+		self.job.lock_work_dirs()
+		self.assertEqual(self.job.job_id, 'test')
+
+	"""
+	Two runs taking over the same stale lock: the second one takes it over
+	while the first one checks the dead pid. The first one must not
+	remove the lock of the second one.
+	"""
+	def test_concurrent_takeover(self):
+		self.leave_lock(str(self.dead_pid()))
+		other = ListWordCount(['words.txt'])
+		other.job_id = 'test'
+		process_alive = MapReduceInterface.process_alive
+		def racing_process_alive(pid):
+			if other.job_id == 'test' and not hasattr(other, 'lock_content'):
+				with mock.patch.object(MapReduceInterface, 'process_alive', process_alive):
+					other.lock_work_dirs()
+			return process_alive(pid)
+		with mock.patch.object(MapReduceInterface, 'process_alive', racing_process_alive):
+			self.job.lock_work_dirs()
+		self.assertEqual(other.job_id, 'test')
+		self.assertNotEqual(self.job.job_id, 'test')
+		with open(os.path.join('#job-test', 'lock')) as fl:
+			self.assertEqual(fl.read(), other.lock_content)
+
+	"""
+	A failed run only removes the lock if it still holds it.
+	"""
+	def test_remove_lock(self):
+		self.job.lock_work_dirs()
+		lock = os.path.join('#job-test', 'lock')
+		MapReduceInterface.remove_lock(lock, 'someone else')
+		self.assertTrue(os.path.exists(lock))
+		MapReduceInterface.remove_lock(lock, self.job.lock_content)
+		self.assertEqual(os.listdir('#job-test'), [])
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,92 @@
+"""
+Tests of the Numeric job. Run from the top directory with
+
+	python -m unittest discover tests
+"""
+
+import os
+import sys
+import ast
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from numeric_ops import Numeric
+
+
+class NumericTest(unittest.TestCase):
+
+	def setUp(self):
+		self.cwd = os.getcwd()
+		self.dir = tempfile.mkdtemp()
+		os.chdir(self.dir)
+
+	def tearDown(self):
+		os.chdir(self.cwd)
+		shutil.rmtree(self.dir)
+
+	"""
+	Run a Numeric job over the given csv text and return the stats of
+	every column.
+	"""
+	def run_job(self, text, columns, **options):
+		with open('data.csv', 'w', newline='') as fl:
+			fl.write(text)
+		job = Numeric(['data.csv'], columns)
+		job.num_processes = 1
+		for name, value in options.items():
+			setattr(job, name, value)
+		job.run_program()
+		with open('map_reduce_output.txt') as fl:
+			return dict(ast.literal_eval(line) for line in fl)
+
+	"""
+	A quoted field with a newline in it stays in one block.
+	"""
+	def test_multiline_field_across_blocks(self):
+		rows = ['%d,x\n' % n for n in range(10)]
+		rows[2] = '2,"line\nbreak"\n'
+		stats = self.run_job('a,b\n' + ''.join(rows), 1, block_rows=3)
+		self.assertEqual(stats[1][:4], (10, 45, 0, 9))
+
+	"""
+	A row starting with # is data, not a comment, with or without NumPy.
+	"""
+	def test_hash_is_not_a_comment(self):
+		stats = self.run_job('a,b\n1,1\n#x,1\n2,1\n', 2)
+		self.assertEqual(stats[2][:4], (3, 3, 1, 1))
+
+	"""
+	The standard deviation of floats with a large mean doesn't cancel,
+	whether the partials come from one block or many.
+	"""
+	def test_float_standard_deviation(self):
+		text = 'a\n' + ''.join('%r\n' % (1e9 + 0.1 * (n % 2)) for n in range(1000))
+		for block_rows in (65536, 7):
+			stats = self.run_job(text, 1, block_rows=block_rows)
+			self.assertEqual(stats[1][0], 1000)
+			self.assertAlmostEqual(stats[1][5], 0.05, places=6)
+
+	"""
+	Integer columns stay exact.
+	"""
+	def test_integer_stats_are_exact(self):
+		values = [10 ** 15 + n for n in range(100)]
+		stats = self.run_job('a\n' + ''.join('%d\n' % v for v in values), 1, block_rows=9)
+		self.assertEqual(stats[1][:4], (100, sum(values), min(values), max(values)))
+		self.assertAlmostEqual(stats[1][5], 28.866070047722118)
+
+	"""
+	Quoted fields with newlines survive the partitioning into chunks.
+	"""
+	def test_multiline_fields_across_chunks(self):
+		rows = ['%d,"note ""%d""\nsecond line",%d\n' % (n, n, n % 7) for n in range(500)]
+		stats = self.run_job('a,b,c\n' + ''.join(rows), [1, 3], split_size=997, min_split_size=100)
+		self.assertEqual(stats[1][:4], (500, sum(range(500)), 0, 499))
+		self.assertEqual(stats[3][:2], (500, sum(n % 7 for n in range(500))))
+
+
+if __name__ == '__main__':
+	unittest.main()
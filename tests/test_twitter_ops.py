@@ -0,0 +1,117 @@
+"""
+Tests of the Twitter job and of the JSON predicate pushdown. Run from
+the top directory with
+
+	python -m unittest discover tests
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from map_reduce import MapReduceInterface
+from twitter_ops import Twitter
+
+
+"""
+A job that writes the documents its mapper gets, to check what the json
+reader hands over.
+"""
+class Documents(MapReduceInterface):
+
+	def __init__(self, files):
+		MapReduceInterface.__init__(self, self.mapper, self.reducer, files)
+
+	def mapper(self, documents):
+		for document in documents:
+			yield (json.dumps(document, sort_keys=True), 1)
+
+	def reducer(self, key_values_list):
+		for key, values in key_values_list:
+			yield (key, sum(values))
+
+
+def above_five(n):
+	return n > 5
+
+
+class PushdownTest(unittest.TestCase):
+
+	def setUp(self):
+		self.cwd = os.getcwd()
+		self.dir = tempfile.mkdtemp()
+		os.chdir(self.dir)
+
+	def tearDown(self):
+		os.chdir(self.cwd)
+		shutil.rmtree(self.dir)
+
+	"""
+	Write the given raw lines to t.json, run the job over it and return
+	its output lines and the metrics of its map phase.
+	"""
+	def run_job(self, job_class, lines, *args, **options):
+		with open('t.json', 'w') as fl:
+			fl.write(''.join(line + '\n' for line in lines))
+		job = job_class(['t.json'], *args)
+		job.num_processes = 1
+		job.output_format = 'tsv'
+		for name, value in options.items():
+			setattr(job, name, value)
+		metrics = job.run_program()
+		with open('map_reduce_output.txt') as fl:
+			return sorted(fl.read().splitlines()), metrics['phases']['map']
+
+	"""
+	Values escaped differently by different encoders still match.
+	"""
+	def test_escaped_values_match(self):
+		lines = ['{"id": 1, "source": "AT\\u0026T"}', '{"id": 2, "source": "AT&T"}',
+			'{"id": 3, "source": "a\\/b"}', '{"id": 4, "source": "a/b"}',
+			'{"id": 5, "source": "caf\\u00e9"}', '{"id": 6, "source": "café"}',
+			'{"id": 7, "source": "\\u003cb\\u003e"}', '{"id": 8, "source": "<b>"}']
+		for value, expected in (('AT&T', 2), ('a/b', 2), ('café', 2), ('<b>', 2)):
+			output, metrics = self.run_job(Twitter, lines, 'source', value)
+			self.assertEqual(sum(int(line) for line in output), expected, value)
+
+	"""
+	Lines without the raw text of a plain value are skipped unparsed,
+	the others are parsed and checked.
+	"""
+	def test_prefilter(self):
+		lines = ['{"id": 1, "lang": "en"}', '{"id": 2, "lang": "fr"}',
+			'{"id": 3, "lang": "fr", "user": {"lang": "en"}}', '{"id": 4}', '']
+		output, metrics = self.run_job(Twitter, lines, 'lang', 'en')
+		self.assertEqual(sum(int(line) for line in output), 1)
+		self.assertEqual(metrics['json_lines_skipped'], 2)
+		self.assertEqual(metrics['json_records_filtered'], 1)
+		output, metrics = self.run_job(Twitter, lines, 'user.lang', 'en')
+		self.assertEqual(sum(int(line) for line in output), 1)
+
+	"""
+	Numbers, booleans, null and callables match on the parsed values.
+	"""
+	def test_conditions(self):
+		lines = ['{"n": 5, "b": true, "x": null}', '{"n": 5.0, "b": 1, "x": null}',
+			'{"n": 6, "b": true, "x": 0}', '{"n": 5, "b": false}']
+		self.assertEqual(len(self.run_job(Documents, lines, json_where={'n': 5, 'b': True})[0]), 2)
+		self.assertEqual(len(self.run_job(Documents, lines, json_where={'x': None})[0]), 2)
+		self.assertEqual(len(self.run_job(Documents, lines, json_where={'n': above_five})[0]), 1)
+
+	"""
+	Documents are cut down to json_fields, nested like in the document,
+	and fields they don't have are left out.
+	"""
+	def test_projection(self):
+		lines = ['{"id": 1, "text": "hi", "user": {"id": 7, "name": "a", "lang": "en"}}', '{"id": 2, "user": 3}']
+		output, metrics = self.run_job(Documents, lines, json_fields=['id', 'user.id', 'user.lang', 'missing'])
+		self.assertEqual(output, ['{"id": 1, "user": {"id": 7, "lang": "en"}}\t1', '{"id": 2}\t1'])
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -28,13 +28,11 @@ Date: 11/02/2014
 Twitter program that inherits from the MapReduce framework.
 Takes an attribute name and value and returns the total
 number of tweets where attr=attr_value. The input file is in
-.json format and is a collection of tweets.
+.json format and is a collection of tweets, one tweet per line.
 """
 
 from map_reduce import *
 
-import json
-
 """
 Twitter class.
 """
@@ -42,12 +40,19 @@ class Twitter(MapReduceInterface):
 
 	"""
 	files: the files that the Twitter program should run on.
-	attr:  attribute of a tweet. E.g. 'lang'
+	attr:  attribute of a tweet. E.g. 'lang', or 'user.lang' for an
+	       attribute of a nested object.
 	attr value: the value of the attribute. E.g. 'en'
+
+	The condition is pushed down to the framework, which skips the lines
+	that can't match without parsing them and hands the mapper only the
+	matching tweets, cut down to their id.
 	"""
 	def __init__(self, files, attr, attr_value):
 		self.attr = attr
 		self.attr_value = attr_value
+		self.json_where = {attr: attr_value}
+		self.json_fields = ['id']
 		self.files = files
 		mapper = self.mapper
 		reducer = self.reducer
@@ -55,22 +60,12 @@ class Twitter(MapReduceInterface):
 
 	"""
 	The map function for twitter program.
-	Takes a chunk .json file and returns a list of tweet ids where
-	attr=attr_value.
+	Takes an iterator of the tweets in a .json chunk where
+	attr=attr_value (see json_where) and yields their ids.
 	"""
-	def mapper(self, json_file):
-		json_data = json_file.read()
-		results = []
-		json_list = []
-
-		json_list = json.loads(json_data)
-		for tweet in json_list:
-			if not self.attr in tweet:
-				pass
-			else:
-				if tweet[self.attr] == self.attr_value:
-					results.append((tweet['id'], 1))	
-		return results
+	def mapper(self, tweets):
+		for tweet in tweets:
+			yield (tweet['id'], 1)
 
 	"""
 	The reduce function for twitter program.
@@ -81,3 +76,11 @@ class Twitter(MapReduceInterface):
 			total_sum +=  sum(entry[1])
 		return total_sum
 
+	"""
+	The combiner for twitter program. Sums the values of each tweet id
+	so duplicated tweets leave the map task as one (id, count) pair.
+	"""
+	def combiner(self, key_values_list):
+		for key, values in key_values_list:
+			yield (key, sum(values))
+
@@ -30,6 +30,7 @@ Counts the number of occurances of each word in the files.
 """
 
 from map_reduce import *
+from sketches import HyperLogLog, CountMinSketch, TDigest, merge_sketches
 
 """
 WordCount class.
@@ -50,24 +51,77 @@ class WordCount(MapReduceInterface):
 	"""
 	The map function for WordCount program.
 	file_chunk is the same format file as the initial input files.
-	Produce a (key, value) pair for each word in the text.
+	Yields a (key, value) pair for each word in the text.
 	"""
 	def mapper(self, file_chunk):
-		text = file_chunk.read()
-		results = []
-		text = text.split()
-		for w in text:
-			results.append((w,1))
-		return results
+		for line in file_chunk:
+			for w in line.split():
+				yield (w, 1)
 
 	"""
-	Gets a list of [('a', 1), ('b', [1, 1, 1, 1]), ...]
-	and returns [(a, total_freq), (b, total_freq), ...].
+	Gets a stream of ('a', [1]), ('b', [1, 1, 1, 1]), ...
+	and yields (a, total_freq), (b, total_freq), ...
 	"""
 	def reducer(self, key_values_list):
-		result = []
-		for entry in key_values_list:
-			key = entry[0]
-			sum_of_values = sum(entry[1])
-			result.append((key,sum_of_values))
-		return result
+		for key, values in key_values_list:
+			yield (key, sum(values))
+
+	"""
+	Summing the counts is associative, so the reducer doubles as the
+	combiner: each map task writes (word, count) instead of (word, 1) pairs.
+	"""
+	combiner = reducer
+
+
+"""
+WordSketch class.
+
+Answers the WordCount questions approximately with mergeable sketches:
+the number of distinct words, the top_k most frequent words and the
+quantiles of the word lengths. Every map task yields three sketches
+instead of one pair per word, so the shuffle moves a few kilobytes per
+task whatever the size of the vocabulary.
+"""
+class WordSketch(MapReduceInterface):
+
+	top_k = 10
+
+	"""
+	files: the files that the WordSketch program should run on.
+	"""
+	def __init__(self, files):
+		self.files = files
+		mapper = self.mapper
+		reducer = self.reducer
+		MapReduceInterface.__init__(self,  mapper, reducer, files)
+
+	"""
+	The map function for WordSketch program. Builds the sketches of the
+	words of the chunk and yields them.
+	"""
+	def mapper(self, file_chunk):
+		distinct = HyperLogLog()
+		frequent = CountMinSketch(top_k=self.top_k)
+		lengths = TDigest()
+		for line in file_chunk:
+			for w in line.split():
+				distinct.add(w)
+				frequent.add(w)
+				lengths.add(len(w))
+		yield ('distinct words', distinct)
+		yield ('top words', frequent)
+		yield ('word lengths', lengths)
+
+	"""
+	Merging sketches is associative, so the sketches are merged in a tree
+	by the combiner of every map, merge and combine task.
+	"""
+	combiner = staticmethod(merge_sketches)
+
+	"""
+	Merges the sketches of every key and yields the merged sketch, which
+	prints its estimate along with the bound of its error.
+	"""
+	def reducer(self, key_values_list):
+		for key, sketch in merge_sketches(key_values_list):
+			yield (key, sketch)